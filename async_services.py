@@ -0,0 +1,75 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from firebase_admin import db
+
+from telemetry import current_stage, metrics
+
+# Concurrency limits, overridable from the environment
+GENAI_MAX_CONCURRENCY = int(os.environ.get("GENAI_MAX_CONCURRENCY", "8"))
+FIREBASE_MAX_WORKERS = int(os.environ.get("FIREBASE_MAX_WORKERS", "16"))
+
+
+class GenAIService:
+    """Async front for the GenAI client that caps the number of in-flight requests."""
+
+    def __init__(self, client, model: str, max_concurrency: int = GENAI_MAX_CONCURRENCY):
+        self.client = client
+        self.model = model
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def generate_content(self, contents, config=None):
+        # Uses the SDK's native async API so the event loop is never blocked on the request
+        async with self._semaphore:
+            metrics.count("llm_calls", stage=current_stage())
+            response = await self.client.aio.models.generate_content(
+                model=self.model, contents=contents, config=config,
+            )
+        metrics.record_usage(response.usage_metadata)
+        return response
+
+    async def generate_content_stream(self, contents, config=None):
+        # Yields response chunks as they arrive, holding a concurrency slot until the stream ends
+        async with self._semaphore:
+            metrics.count("llm_calls", stage=current_stage())
+            stream = await self.client.aio.models.generate_content_stream(
+                model=self.model, contents=contents, config=config,
+            )
+            usage = None
+            async for chunk in stream:
+                # Each chunk carries the running usage, so only the last one is counted
+                usage = chunk.usage_metadata or usage
+                yield chunk
+        metrics.record_usage(usage)
+
+
+class FirebaseService:
+    """Runs blocking firebase_admin.db calls on a bounded thread pool."""
+
+    def __init__(self, max_workers: int = FIREBASE_MAX_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="firebase")
+
+    async def run(self, fn, *args, **kwargs):
+        metrics.count("db_round_trips", backend="firebase")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    async def get(self, path: str):
+        return await self.run(lambda: db.reference(path).get())
+
+    async def set(self, path: str, value):
+        await self.run(lambda: db.reference(path).set(value))
+
+    async def update(self, path: str, value: dict):
+        await self.run(lambda: db.reference(path).update(value))
+
+    async def delete(self, path: str):
+        await self.run(lambda: db.reference(path).delete())
+
+    async def transaction(self, path: str, update_fn):
+        return await self.run(lambda: db.reference(path).transaction(update_fn))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
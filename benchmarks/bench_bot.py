@@ -0,0 +1,242 @@
+"""Drive the bot's commands and reaction handlers end to end against local stand-ins.
+
+Discord, Gemini and the database are replaced with in-process fakes that add
+configurable latency, so the run measures the bot's own overhead and how it
+behaves under concurrency. Reports p50/p99 latency per command, how long the
+event loop was blocked, and how many backend, GenAI and REST calls were made.
+Commands report most failures as an error reply and an error log line rather
+than raising, so a call that logs an error is counted as failed, left out of
+the latency samples, and makes the run exit non-zero.
+
+    python -m benchmarks.bench_bot --requests 200 --concurrency 20
+    python -m benchmarks.bench_bot --backend sqlite --llm-latency 1.5 --llm-notes
+"""
+import argparse
+import asyncio
+import contextvars
+import io
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from types import SimpleNamespace
+
+# The bot reads its configuration at import time, so point it at throwaway local state first
+_workdir = tempfile.mkdtemp(prefix="bench-bot-")
+os.environ["LEDGER_BACKEND"] = "sqlite"
+os.environ["LEDGER_SQLITE_PATH"] = os.path.join(_workdir, "ledger.sqlite3")
+os.environ["RECEIPT_CACHE_PATH"] = os.path.join(_workdir, "receipts.sqlite3")
+os.environ.setdefault("GENAI_API_KEY", "bench")
+
+from PIL import Image, ImageDraw
+
+import receipt_bot
+from benchmarks.fake_firebase import FakeFirebase
+from benchmarks.fakes import FakeAttachment, FakeContext, FakeGenAI, FakeGuild, FakeMember, FakeRest, next_id
+from directory import GuildDirectory
+from firebase_ledger import FirebaseLedger
+from item_index import ItemMessageIndex
+
+BOT_ID = 1
+
+
+def receipt_image(rng: random.Random) -> bytes:
+    # A white slip with random lines of "text" on a dark table, unique per call
+    image = Image.new("RGB", (1200, 1600), (40, 30, 25))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((300, 100, 900, 1500), fill=(245, 245, 240))
+    for row in range(140, 1460, 40):
+        draw.rectangle((340, row, 340 + rng.randint(100, 500), row + 14), fill=(30, 30, 30))
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=85)
+    return buffer.getvalue()
+
+
+class ErrorLog(logging.Handler):
+    """Collects error log lines into the list of whichever benchmark call (and the tasks it started) logged them."""
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.current = contextvars.ContextVar("bench_call_errors", default=None)
+
+    def emit(self, record: logging.LogRecord):
+        errors = self.current.get()
+        if errors is not None:
+            errors.append(record.getMessage())
+
+
+def percentile(samples: list[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class LoopMonitor:
+    """Ticks the event loop and records how late each tick was, i.e. time the loop spent blocked."""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.lags = []
+        self._task = None
+
+    async def _tick(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - start - self.interval))
+
+    def start(self):
+        self._task = asyncio.create_task(self._tick())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+async def run_phase(name: str, count: int, concurrency: int, make_call, latencies: dict, failures: dict, error_log: ErrorLog):
+    # Run count calls with at most concurrency in flight, timing the ones that succeed
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with semaphore:
+            errors = []
+            error_log.current.set(errors)
+            start = time.perf_counter()
+            try:
+                await make_call(i)
+            except Exception as e:
+                errors.append(f"{type(e).__name__}: {e}")
+            elapsed = time.perf_counter() - start
+            if errors:
+                failures[name].extend(errors)
+            else:
+                latencies[name].append(elapsed)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(count)))
+    return time.perf_counter() - start
+
+
+async def main(args):
+    rng = random.Random(args.seed)
+    rest = FakeRest(args.rest_latency)
+    items = {f"Item {i}": round(rng.uniform(2, 25), 2) for i in range(args.items)}
+    genai = FakeGenAI(items, args.llm_latency)
+    firebase = FakeFirebase(latency=args.db_latency)
+
+    # Swap the bot's external services for the fakes
+    receipt_bot.llm = genai
+    if args.backend == "firebase":
+        receipt_bot.ledger = FirebaseLedger(firebase)
+    receipt_bot.item_index = ItemMessageIndex(receipt_bot.ledger)
+    receipt_bot.directory = GuildDirectory(receipt_bot.ledger)
+    receipt_bot.bot._connection.user = FakeMember(BOT_ID, "bench-bot")
+
+    members = [FakeMember(next_id(), f"user{i}") for i in range(args.members)]
+    guilds = [FakeGuild(next_id(), members, rest) for _ in range(args.guilds)]
+    images = [receipt_image(rng) for _ in range(max(1, args.unique_images))]
+
+    def context(attach: bool = False, mentions: int = 0) -> FakeContext:
+        author, *diners = rng.sample(members, mentions + 1)
+        attachments = [FakeAttachment(rng.choice(images))] if attach else None
+        return FakeContext(rng.choice(guilds), author, rest, attachments=attachments, mentions=diners)
+
+    react_contexts = []
+
+    def react_context() -> FakeContext:
+        ctx = context(attach=True)
+        react_contexts.append(ctx)
+        return ctx
+
+    notes = "the person in the red hat had the soup" if args.llm_notes else ""
+    calls = {
+        "receipt react": lambda i: receipt_bot.receipt.callback(react_context(), "react", "15%", ""),
+        "receipt pick": lambda i: receipt_bot.receipt.callback(context(attach=True), "pick", "15%", ""),
+        "receipt share": lambda i: receipt_bot.receipt.callback(
+            context(attach=True, mentions=rng.randint(1, 4)), "share", "15%", notes),
+        "due": lambda i: receipt_bot.due.callback(context(), rng.choice(members), round(rng.uniform(1, 50), 2)),
+        "owes": lambda i: receipt_bot.owes.callback(context(), *rng.sample(members, 2)),
+        "owed": lambda i: receipt_bot.owed.callback(context()),
+    }
+
+    latencies = defaultdict(list)
+    failures = defaultdict(list)
+    error_log = ErrorLog()
+    logging.getLogger().addHandler(error_log)
+    monitor = LoopMonitor()
+    monitor.start()
+    elapsed = {}
+    for name, call in calls.items():
+        elapsed[name] = await run_phase(name, args.requests, args.concurrency, call, latencies, failures, error_log)
+
+    # React to and un-react from the item messages the react phase posted
+    item_messages = [(ctx.guild.id, reply.id) for ctx in react_contexts for reply in ctx.replies]
+
+    def reaction(i, remove=False):
+        guild_id, msg_id = item_messages[i % len(item_messages)]
+        return SimpleNamespace(
+            user_id=members[(i * 7) % len(members)].id, guild_id=guild_id, channel_id=next_id(),
+            message_id=msg_id, message_author_id=None if remove else BOT_ID, emoji="✅",
+        )
+
+    if item_messages:
+        count = args.requests * 5
+        elapsed["reaction add"] = await run_phase(
+            "reaction add", count, args.concurrency * 5,
+            lambda i: receipt_bot.on_raw_reaction_add(reaction(i)), latencies, failures, error_log)
+        elapsed["reaction remove"] = await run_phase(
+            "reaction remove", count, args.concurrency * 5,
+            lambda i: receipt_bot.on_raw_reaction_remove(reaction(i, remove=True)), latencies, failures, error_log)
+    await monitor.stop()
+
+    print(f"{args.requests} requests per command at concurrency {args.concurrency}, "
+          f"{args.guilds} guilds, {args.members} members, {args.items} items per receipt")
+    print(f"{'command':<16} {'n':>6} {'errors':>7} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9} {'req/s':>8}")
+    for name in elapsed:
+        samples = latencies[name]
+        if not samples:
+            print(f"{name:<16} {0:>6} {len(failures[name]):>7} {'-':>9} {'-':>9} {'-':>9} {'-':>8}")
+            continue
+        print(f"{name:<16} {len(samples):>6} {len(failures[name]):>7} {percentile(samples, 0.5) * 1000:>9.1f} "
+              f"{percentile(samples, 0.99) * 1000:>9.1f} {max(samples) * 1000:>9.1f} "
+              f"{len(samples) / elapsed[name]:>8.1f}")
+    lags = monitor.lags or [0.0]
+    print(f"event loop: blocked {sum(lags) * 1000:.0f} ms in total, p99 tick lag {percentile(lags, 0.99) * 1000:.1f} ms, "
+          f"worst {max(lags) * 1000:.1f} ms, mean {statistics.mean(lags) * 1000:.2f} ms")
+    if args.backend == "firebase":
+        print(f"backend round trips: {sum(firebase.calls.values())} {dict(firebase.calls)}")
+    print(f"GenAI calls: {sum(genai.calls.values())} {dict(genai.calls)}")
+    print(f"REST calls: {sum(rest.calls.values())} {dict(rest.calls)}")
+    print(f"receipt cache: {receipt_bot.receipt_cache.stats}")
+
+    failed = {name: errors for name, errors in failures.items() if errors}
+    for name, errors in failed.items():
+        print(f"{name}: {len(errors)} failed calls, first error: {errors[0]}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=["firebase", "sqlite"], default="firebase",
+                        help="in-memory Firebase stand-in, or a temporary SQLite ledger")
+    parser.add_argument("--requests", type=int, default=100, help="calls per command")
+    parser.add_argument("--concurrency", type=int, default=10, help="calls in flight per command")
+    parser.add_argument("--guilds", type=int, default=5)
+    parser.add_argument("--members", type=int, default=50)
+    parser.add_argument("--items", type=int, default=12, help="items on each canned receipt")
+    parser.add_argument("--unique-images", type=int, default=1000,
+                        help="distinct receipt photos, fewer than requests means receipt cache hits")
+    parser.add_argument("--llm-latency", type=float, default=0.8, help="simulated seconds per GenAI call")
+    parser.add_argument("--db-latency", type=float, default=0.02, help="simulated seconds per backend call")
+    parser.add_argument("--rest-latency", type=float, default=0.05, help="simulated seconds per Discord REST call")
+    parser.add_argument("--llm-notes", action="store_true",
+                        help="use share notes the local splitter can't parse, so every share runs the actor/critic loop")
+    parser.add_argument("--seed", type=int, default=0)
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,90 @@
+"""Measure the receipt preprocessing pipeline over a folder of sample photos.
+
+Reports bytes sent and preprocessing time per image. With --parse, each image
+is also parsed by Gemini both raw and preprocessed (needs GENAI_API_KEY) and
+the two parses are compared item by item.
+
+    python -m benchmarks.bench_preprocess samples/ --max-edge 1600 --parse
+"""
+import argparse
+import os
+import statistics
+import time
+from pathlib import Path
+
+from image_preprocess import PREPROCESS_MAX_EDGE, preprocess_receipt
+from prompts import RECEIPT_PROMPT, ReceiptOutput
+from split_engine import to_cents
+
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png"}
+
+
+def parse(client, model: str, data: bytes, mime_type: str) -> dict:
+    from google.genai import types
+
+    response = client.models.generate_content(
+        model=model, contents=[RECEIPT_PROMPT, types.Part.from_bytes(data=data, mime_type=mime_type)],
+        config={"response_mime_type": "application/json", "response_schema": ReceiptOutput},
+    )
+    # Repeated names are summed, the comparison is by name
+    items = {}
+    for item in ReceiptOutput.model_validate_json(response.text).items:
+        items[item.name] = items.get(item.name, 0) + item.price
+    return items
+
+
+def agreement(baseline: dict, candidate: dict) -> tuple[float, int]:
+    # Share of baseline items found with the same price to the cent, and the difference in totals in cents
+    normalized = {name.strip().lower(): to_cents(price) for name, price in candidate.items()}
+    matched = sum(1 for name, price in baseline.items() if normalized.get(name.strip().lower()) == to_cents(price))
+    total_diff = sum(normalized.values()) - sum(to_cents(p) for p in baseline.values())
+    return (matched / len(baseline) if baseline else 1.0), total_diff
+
+
+def main(folder: Path, max_edge: int, run_parse: bool, model: str):
+    paths = sorted(p for p in folder.iterdir() if p.suffix.lower() in IMAGE_SUFFIXES)
+    if not paths:
+        raise SystemExit(f"No .jpg or .png files in {folder}")
+
+    client = None
+    if run_parse:
+        from google import genai
+
+        client = genai.Client(api_key=os.environ.get("GENAI_API_KEY"))
+
+    rows = []
+    print(f"{'image':<32} {'original':>10} {'sent':>10} {'ratio':>6} {'ms':>8}" + (f" {'items':>6} {'total':>7}" if run_parse else ""))
+    for path in paths:
+        original = path.read_bytes()
+        start = time.perf_counter()
+        processed = preprocess_receipt(original, max_edge=max_edge)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        row = {"original": len(original), "sent": len(processed), "ms": elapsed_ms}
+        line = f"{path.name[:32]:<32} {len(original):>10} {len(processed):>10} {len(processed) / len(original):>6.2f} {elapsed_ms:>8.1f}"
+        if client:
+            mime_type = "image/png" if path.suffix.lower() == ".png" else "image/jpeg"
+            baseline = parse(client, model, original, mime_type)
+            candidate = parse(client, model, processed, "image/jpeg")
+            row["agreement"], row["total_diff"] = agreement(baseline, candidate)
+            line += f" {row['agreement']:>6.0%} {row['total_diff'] / 100:>7.2f}"
+        rows.append(row)
+        print(line)
+
+    original_total = sum(r["original"] for r in rows)
+    sent_total = sum(r["sent"] for r in rows)
+    print(f"\n{len(rows)} images: {original_total} bytes -> {sent_total} bytes ({sent_total / original_total:.1%})")
+    times = sorted(r["ms"] for r in rows)
+    print(f"preprocess ms: mean {statistics.mean(times):.1f}, p50 {times[len(times) // 2]:.1f}, max {times[-1]:.1f}")
+    if client:
+        print(f"mean item agreement {statistics.mean(r['agreement'] for r in rows):.1%}, "
+              f"receipts with matching totals {sum(1 for r in rows if r['total_diff'] == 0)}/{len(rows)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("folder", type=Path)
+    parser.add_argument("--max-edge", type=int, default=PREPROCESS_MAX_EDGE)
+    parser.add_argument("--parse", action="store_true", help="also compare Gemini parses of raw and preprocessed images")
+    parser.add_argument("--model", default="gemini-2.5-flash")
+    args = parser.parse_args()
+    main(args.folder, args.max_edge, args.parse, args.model)
@@ -0,0 +1,59 @@
+"""Time debt netting and settlement planning over synthetic guild ledgers.
+
+    python -m benchmarks.bench_settle --members 5000 --entries 200000
+"""
+import argparse
+import random
+import time
+from collections import defaultdict
+
+from settlement import net_balances, settle
+
+
+def synthetic_debts(members: int, entries: int, rng: random.Random) -> list[tuple]:
+    # Raw ledger entries folded into per-pair totals, the shape the running balances index stores
+    pairs = defaultdict(int)
+    # A few regulars pay for most meals, like a real friend group
+    payers = rng.sample(range(members), max(1, members // 20))
+    for _ in range(entries):
+        creditor = rng.choice(payers) if rng.random() < 0.7 else rng.randrange(members)
+        debtor = rng.randrange(members)
+        if debtor != creditor:
+            pairs[(debtor, creditor)] += rng.randint(100, 5000)
+    return [(debtor, creditor, cents) for (debtor, creditor), cents in pairs.items()]
+
+
+def main(members: int, entries: int, runs: int, seed: int):
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    debts = synthetic_debts(members, entries, rng)
+    print(f"{members} members, {entries} entries -> {len(debts)} debtor/creditor pairs "
+          f"(generated in {time.perf_counter() - start:.2f}s)")
+
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        net = net_balances(debts)
+        transfers = settle(net)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    # Applying the plan must leave everyone at zero
+    check = dict(net)
+    for payer, payee, cents in transfers:
+        check[payer] += cents
+        check[payee] -= cents
+    assert not any(check.values()), "settlement plan does not balance"
+
+    timings.sort()
+    print(f"net + settle ms: p50 {timings[len(timings) // 2]:.1f}, max {timings[-1]:.1f} over {runs} runs")
+    print(f"{len(debts)} gross debts -> {len(transfers)} transfers for {len(net)} users with a non-zero balance")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--members", type=int, default=5000)
+    parser.add_argument("--entries", type=int, default=200000)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    main(args.members, args.entries, args.runs, args.seed)
@@ -0,0 +1,92 @@
+import asyncio
+import copy
+from collections import Counter
+
+
+def _split(path: str) -> list[str]:
+    return [part for part in str(path).split('/') if part]
+
+
+def _normalize(value):
+    # The real database stores arrays as objects keyed "0", "1", ...
+    if isinstance(value, list):
+        value = {str(i): v for i, v in enumerate(value) if v is not None}
+    if isinstance(value, dict):
+        return {str(k): _normalize(v) for k, v in value.items() if v is not None}
+    return value
+
+
+class FakeFirebase:
+    """In-memory stand-in for FirebaseService with per-call latency and counters.
+
+    Paths behave like the Realtime Database: setting None deletes a node, empty
+    parents disappear, and update() applies all of its paths atomically.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.data = {}
+        self.calls = Counter()
+
+    async def _round_trip(self, kind: str):
+        self.calls[kind] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def _read(self, path: str):
+        node = self.data
+        for part in _split(path):
+            if not isinstance(node, dict) or part not in node:
+                return None
+            node = node[part]
+        return copy.deepcopy(node)
+
+    def _write(self, path: str, value):
+        parts = _split(path)
+        if not parts:
+            self.data = _normalize(value) if isinstance(value, dict) else {}
+            return
+        node = self.data
+        trail = []
+        for part in parts[:-1]:
+            trail.append((node, part))
+            node = node.setdefault(part, {})
+        if value is None:
+            node.pop(parts[-1], None)
+        else:
+            node[parts[-1]] = _normalize(value)
+        # Prune parents left empty by a delete
+        for parent, part in reversed(trail):
+            if parent[part]:
+                break
+            del parent[part]
+
+    async def run(self, fn, *args, **kwargs):
+        await self._round_trip('run')
+        return fn(*args, **kwargs)
+
+    async def get(self, path: str):
+        await self._round_trip('get')
+        return self._read(path)
+
+    async def set(self, path: str, value):
+        await self._round_trip('set')
+        self._write(path, value)
+
+    async def update(self, path: str, value: dict):
+        await self._round_trip('update')
+        for child, child_value in value.items():
+            self._write(f'{path}/{child}', child_value)
+
+    async def delete(self, path: str):
+        await self._round_trip('delete')
+        self._write(path, None)
+
+    async def transaction(self, path: str, update_fn):
+        await self._round_trip('transaction')
+        result = update_fn(self._read(path))
+        self._write(path, result)
+        return result
+
+    def shutdown(self):
+        pass
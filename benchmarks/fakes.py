@@ -0,0 +1,127 @@
+import asyncio
+import itertools
+import json
+import re
+from collections import Counter
+from types import SimpleNamespace
+
+_ids = itertools.count(10**17)
+
+
+def next_id() -> int:
+    return next(_ids)
+
+
+class FakeMember:
+    def __init__(self, user_id: int, name: str):
+        self.id = user_id
+        self.name = name
+        self.mention = f"<@{user_id}>"
+        self.bot = False
+
+
+class FakeMessage:
+    def __init__(self, channel, author, content: str = "", attachments=None, mentions=None):
+        self.id = next_id()
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.attachments = attachments or []
+        self.mentions = mentions or []
+
+
+class FakeRest:
+    """Counts and delays every call that would be a Discord REST request."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = Counter()
+
+    async def call(self, kind: str):
+        self.calls[kind] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int, members: list[FakeMember], rest: FakeRest):
+        self.id = guild_id
+        self.name = f"guild-{guild_id}"
+        self._members = {m.id: m for m in members}
+        self.rest = rest
+
+    def get_member(self, user_id: int):
+        return self._members.get(user_id)
+
+    async def fetch_member(self, user_id: int):
+        await self.rest.call('fetch_member')
+        return self._members[user_id]
+
+
+class FakeContext:
+    """Just enough of commands.Context for the bot's command callbacks."""
+
+    def __init__(self, guild: FakeGuild, author: FakeMember, rest: FakeRest, attachments=None, mentions=None):
+        self.guild = guild
+        self.author = author
+        self.rest = rest
+        self.channel = SimpleNamespace(id=next_id())
+        self.message = FakeMessage(self.channel, author, attachments=attachments, mentions=mentions)
+        self.replies = []
+
+    async def reply(self, content: str = "", **kwargs):
+        await self.rest.call('send_message')
+        message = FakeMessage(self.channel, None, content=content)
+        self.replies.append(message)
+        return message
+
+
+class FakeAttachment:
+    def __init__(self, data: bytes, filename: str = "receipt.jpg"):
+        self.data = data
+        self.filename = filename
+        self.content_type = "image/jpeg"
+
+    async def read(self) -> bytes:
+        return self.data
+
+
+class FakeGenAI:
+    """Stand-in for GenAIService with fixed latency and canned receipt, split and critic output."""
+
+    def __init__(self, items: dict, latency: float, stream_chunks: int = 8):
+        self.items = items
+        self.latency = latency
+        self.stream_chunks = stream_chunks
+        self.calls = Counter()
+
+    def _respond(self, contents, config):
+        schema = config["response_schema"].__name__ if config else None
+        if schema == "CriticOutput":
+            self.calls['critic'] += 1
+            parsed = {"is_correct": True, "explanation": "Totals match."}
+            return SimpleNamespace(text=json.dumps(parsed), parsed=parsed)
+        if schema == "SplitOutput":
+            self.calls['actor'] += 1
+            # Split evenly between the diners listed in the prompt
+            diners = re.search(r"The diners' IDs are: \[([^\]]*)\]", contents[0]).group(1).split(", ")
+            share = round(sum(self.items.values()) / len(diners), 2)
+            split = {"shares": [{"user": diner, "amount": share} for diner in diners], "explanation": "Split evenly."}
+            return SimpleNamespace(text=json.dumps(split), parsed=None)
+        self.calls['receipt'] += 1
+        receipt = {
+            "items": [{"name": name, "price": price} for name, price in self.items.items()],
+            "total": round(sum(self.items.values()), 2),
+        }
+        return SimpleNamespace(text=json.dumps(receipt), parsed=None)
+
+    async def generate_content(self, contents, config=None):
+        await asyncio.sleep(self.latency)
+        return self._respond(contents, config)
+
+    async def generate_content_stream(self, contents, config=None):
+        text = self._respond(contents, config).text
+        size = max(1, len(text) // self.stream_chunks)
+        for start in range(0, len(text), size):
+            await asyncio.sleep(self.latency / self.stream_chunks)
+            yield SimpleNamespace(text=text[start:start + size])
@@ -0,0 +1,94 @@
+"""Hammer the ledger with simultaneous reaction events and check nothing is lost.
+
+    python -m benchmarks.stress_ledger --users 40 --items 30 --latency 0.02
+    python -m benchmarks.stress_ledger --backend sqlite
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from benchmarks.fake_firebase import FakeFirebase
+from firebase_ledger import FirebaseLedger
+from split_engine import to_cents
+from sqlite_ledger import SQLiteLedger
+
+GUILD = 1
+CREDITOR = 999
+
+
+async def main(backend: str, users: int, items: int, latency: float, seed: int):
+    rng = random.Random(seed)
+    firebase = FakeFirebase(latency=latency)
+    if backend == "sqlite":
+        ledger = SQLiteLedger(os.path.join(tempfile.mkdtemp(), "ledger.sqlite3"))
+    else:
+        ledger = FirebaseLedger(firebase)
+    prices = {f"Item {i}": round(rng.uniform(1, 30), 2) for i in range(items)}
+    msg_ids = {item: 1000 + i for i, item in enumerate(prices)}
+
+    # Every user reacts to a random subset of items, then un-reacts to some of them, all at once
+    events = []
+    expected = set()
+    for user in range(1, users + 1):
+        claimed = rng.sample(list(prices), rng.randint(1, items))
+        for item in claimed:
+            events.append(('add', user, item))
+            if rng.random() < 0.3:
+                events.append(('remove', user, item))
+            else:
+                expected.add((user, item))
+
+    async def react(kind, user, item):
+        # Adds and removes of the same claim are ordered, different claims race freely
+        await asyncio.sleep(rng.uniform(0, latency * 2))
+        if kind == 'add':
+            await ledger.add_item(GUILD, user, CREDITOR, msg_ids[item], item, prices[item])
+        else:
+            await ledger.remove_item(GUILD, user, CREDITOR, msg_ids[item], item)
+
+    claims = {}
+    for kind, user, item in events:
+        claims.setdefault((user, item), []).append(kind)
+
+    async def run_claim(user, item, kinds):
+        for kind in kinds:
+            await react(kind, user, item)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run_claim(user, item, kinds) for (user, item), kinds in claims.items()))
+    elapsed = time.perf_counter() - start
+
+    exported, _, _ = await ledger.export()
+    stored = {(op.debtor_id, op.item) for op in exported}
+    lost = expected - stored
+    extra = stored - expected
+
+    balance_errors = 0
+    for user in range(1, users + 1):
+        want = sum(to_cents(prices[item]) for u, item in expected if u == user)
+        have = await ledger.total_debt(GUILD, user)
+        if to_cents(have) != want:
+            balance_errors += 1
+    mismatches = await ledger.rebuild_balances(GUILD, verify_only=True)
+
+    print(f"{len(events)} reaction events from {users} users over {items} items in {elapsed:.2f}s")
+    if backend == "firebase":
+        print(f"backend round trips: {sum(firebase.calls.values())} {dict(firebase.calls)}")
+    print(f"lost items: {len(lost)}, unexpected items: {len(extra)}, "
+          f"wrong balances: {balance_errors}, index mismatches: {len(mismatches)}")
+    if lost or extra or balance_errors or mismatches:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--backend", choices=["firebase", "sqlite"], default="firebase")
+    parser.add_argument("--users", type=int, default=40)
+    parser.add_argument("--items", type=int, default=30)
+    parser.add_argument("--latency", type=float, default=0.02, help="simulated seconds per backend call")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    asyncio.run(main(args.backend, args.users, args.items, args.latency, args.seed))
@@ -1,25 +1,99 @@
-from typing import Any
-import httpx
+import asyncio
 import logging
-import firebase_admin
-import os
+
+from dotenv import load_dotenv, find_dotenv
 from mcp.server.fastmcp import FastMCP
-import discord
+
+load_dotenv(find_dotenv())
 
 # Initialize FastMCP server
 mcp = FastMCP("bot-mcp-server")
 
-# Constants
-USER_AGENT = "receipt-bot/1.0"
+# The ledger backend is opened on the first tool call, so the server starts without touching the database
+_reader = None
+
+
+def reader():
+    global _reader
+    if _reader is None:
+        from ledger import open_store
+        from ledger_reader import LedgerReader
+
+        logging.info("Opening ledger store")
+        _reader = LedgerReader(open_store())
+    return _reader
+
+
+# Discord IDs are passed and returned as strings, they don't fit in a JSON number without losing precision
+def _bill(items) -> dict:
+    return {
+        "items": [
+            {"debtor_id": str(op.debtor_id), "creditor_id": str(op.creditor_id), "item": op.item, "price": op.price}
+            for op in items
+        ],
+        "total": round(sum(op.price for op in items), 2),
+    }
+
+
+@mcp.tool()
+async def get_balance(guild_id: str, user_id: str) -> dict:
+    """How much a user owes and is owed in a Discord server, in dollars. net is positive when they are owed money."""
+    balances = await reader().balances(int(guild_id), [int(user_id)])
+    return balances[int(user_id)]
+
+
+@mcp.tool()
+async def get_balances(guild_id: str, user_ids: list[str]) -> dict:
+    """Balances for many users of a server in one call, keyed by user ID."""
+    balances = await reader().balances(int(guild_id), [int(user_id) for user_id in user_ids])
+    return {str(user_id): balance for user_id, balance in balances.items()}
+
+
+@mcp.tool()
+async def get_pair_debt(guild_id: str, debtor_id: str, creditor_id: str) -> float:
+    """How much one user owes another in a server, in dollars."""
+    debts = await reader().pair_debts(int(guild_id), [(int(debtor_id), int(creditor_id))])
+    return debts[0]
+
+
+@mcp.tool()
+async def get_pair_debts(guild_id: str, pairs: list[list[str]]) -> list[dict]:
+    """Debts for many [debtor_id, creditor_id] pairs of a server in one call."""
+    debts = await reader().pair_debts(int(guild_id), [(int(debtor), int(creditor)) for debtor, creditor in pairs])
+    return [
+        {"debtor_id": debtor, "creditor_id": creditor, "amount": amount}
+        for (debtor, creditor), amount in zip(pairs, debts)
+    ]
+
+
+@mcp.tool()
+async def get_bill(guild_id: str, bill_id: str) -> dict:
+    """Every item recorded under a bill, the ID of the receipt or $due message that created it."""
+    return _bill(await reader().bill(int(guild_id), int(bill_id)))
+
+
+@mcp.tool()
+async def get_bills(guild_id: str, bill_ids: list[str]) -> dict:
+    """Several bills of a server in one call, keyed by bill ID."""
+    bills = await asyncio.gather(*(reader().bill(int(guild_id), int(bill_id)) for bill_id in bill_ids))
+    return {bill_id: _bill(items) for bill_id, items in zip(bill_ids, bills)}
+
+
+@mcp.tool()
+async def get_aliases(guild_id: str) -> dict:
+    """The names users set with $alias in a server, mapped to their user IDs."""
+    return {alias: str(user_id) for alias, user_id in (await reader().aliases(int(guild_id))).items()}
 
-# Firebase setup
-cred_obj = firebase_admin.credentials.Certificate(os.environ.get("GOOGLE_APPLICATION_CREDENTIALS"))
-default_app = firebase_admin.initialize_app(cred_obj, {
-    'databaseURL': os.environ.get("FIREBASE_DATABASE_URL")
-})
 
+@mcp.tool()
+async def suggest_settlement(guild_id: str) -> list[dict]:
+    """The fewest payments that settle every debt in a server, after netting out who owes whom."""
+    return [
+        {"payer_id": str(payer), "payee_id": str(payee), "amount": cents / 100}
+        for payer, payee, cents in await reader().settlement(int(guild_id))
+    ]
 
 
 if __name__ == "__main__":
     # Initialize and run the server
-    mcp.run(transport='stdio')
\ No newline at end of file
+    mcp.run(transport='stdio')
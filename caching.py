@@ -0,0 +1,140 @@
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from telemetry import metrics
+
+RECEIPT_CACHE_PATH = os.environ.get("RECEIPT_CACHE_PATH", "receipt_cache.sqlite3")
+RECEIPT_CACHE_TTL = float(os.environ.get("RECEIPT_CACHE_TTL", str(30 * 24 * 3600)))
+RECEIPT_CACHE_MEMORY_ENTRIES = int(os.environ.get("RECEIPT_CACHE_MEMORY_ENTRIES", "256"))
+RECEIPT_CACHE_DISK_ENTRIES = int(os.environ.get("RECEIPT_CACHE_DISK_ENTRIES", "10000"))
+
+
+class LRUTTLCache:
+    """In-process LRU cache with an optional per-entry time-to-live."""
+
+    def __init__(self, max_entries: int, ttl: float | None = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        value, expires_at = entry
+        if expires_at is not None and expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ReceiptCache:
+    """Content-addressed cache of parsed receipts.
+
+    Entries live in an in-process LRU backed by a SQLite file, so re-uploads of
+    the same photo survive restarts and never reach the LLM again.
+    """
+
+    def __init__(self, path: str = RECEIPT_CACHE_PATH, ttl: float = RECEIPT_CACHE_TTL,
+                 memory_entries: int = RECEIPT_CACHE_MEMORY_ENTRIES,
+                 disk_entries: int = RECEIPT_CACHE_DISK_ENTRIES):
+        self.ttl = ttl
+        self.disk_entries = disk_entries
+        self._memory = LRUTTLCache(memory_entries, ttl)
+        # A single worker serializes access to the SQLite connection
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="receipt-cache")
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS receipts ("
+            " key TEXT PRIMARY KEY, items TEXT NOT NULL,"
+            " created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS receipts_accessed ON receipts (accessed_at)")
+        self._conn.commit()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+    @staticmethod
+    def key(image_bytes: bytes, model: str, prompt_version) -> str:
+        digest = hashlib.sha256(image_bytes)
+        digest.update(f"\0{model}\0{prompt_version}".encode())
+        return digest.hexdigest()
+
+    async def _run(self, fn, *args):
+        metrics.count("db_round_trips", backend="receipt_cache")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args))
+
+    def _disk_get(self, key: str):
+        now = time.time()
+        row = self._conn.execute(
+            "SELECT items, created_at FROM receipts WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        if row[1] + self.ttl < now:
+            self._conn.execute("DELETE FROM receipts WHERE key = ?", (key,))
+            self._conn.commit()
+            return None
+        self._conn.execute("UPDATE receipts SET accessed_at = ? WHERE key = ?", (now, key))
+        self._conn.commit()
+        return json.loads(row[0])
+
+    def _disk_set(self, key: str, items: dict):
+        now = time.time()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO receipts (key, items, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(items), now, now),
+        )
+        # Evict expired entries first, then the least recently used ones over the size cap
+        self._conn.execute("DELETE FROM receipts WHERE created_at < ?", (now - self.ttl,))
+        self._conn.execute(
+            "DELETE FROM receipts WHERE key IN ("
+            " SELECT key FROM receipts ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.disk_entries,),
+        )
+        self._conn.commit()
+
+    async def get(self, key: str) -> dict | None:
+        items = self._memory.get(key)
+        if items is not None:
+            self.stats["memory_hits"] += 1
+            return dict(items)
+        items = await self._run(self._disk_get, key)
+        if items is not None:
+            self.stats["disk_hits"] += 1
+            self._memory.set(key, items)
+            return dict(items)
+        self.stats["misses"] += 1
+        return None
+
+    async def set(self, key: str, items: dict):
+        self._memory.set(key, dict(items))
+        await self._run(self._disk_set, key, items)
@@ -0,0 +1,85 @@
+"""Run the bot as several processes, each owning a slice of the gateway shards.
+
+    python cluster.py --processes 4 --shards 16
+
+Every process runs receipt_bot.py with SHARD_COUNT and its own SHARD_IDS, so
+a guild's events always land in the same process. Processes share the ledger
+store and the receipt cache, and claim command events in the store so a
+message delivered to two processes during a reshard is only handled once.
+If METRICS_PORT is set, process N serves metrics on METRICS_PORT + N.
+A process that exits is restarted after a short backoff.
+"""
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from dotenv import load_dotenv, find_dotenv
+
+# Seconds to wait before restarting a process that exited, doubled for each quick crash up to the maximum
+RESTART_BACKOFF = 5
+RESTART_BACKOFF_MAX = 300
+
+
+def shard_slices(shards: int, processes: int) -> list[list[int]]:
+    # Contiguous ranges, so shards that start together (identify buckets) mostly share a process
+    per_process, extra = divmod(shards, processes)
+    slices, start = [], 0
+    for i in range(processes):
+        size = per_process + (1 if i < extra else 0)
+        slices.append(list(range(start, start + size)))
+        start += size
+    return slices
+
+
+def spawn(index: int, shard_ids: list[int], shards: int) -> subprocess.Popen:
+    env = dict(os.environ, SHARD_COUNT=str(shards), SHARD_IDS=",".join(map(str, shard_ids)), CLUSTER_ID=str(index))
+    if os.environ.get("METRICS_PORT"):
+        env["METRICS_PORT"] = str(int(os.environ["METRICS_PORT"]) + index)
+    logging.info(f"Starting process {index} with shards {shard_ids[0]}-{shard_ids[-1]} of {shards}")
+    return subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "receipt_bot.py")], env=env)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    load_dotenv(find_dotenv())
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=2)
+    parser.add_argument("--shards", type=int, help="total shard count, defaults to one per process")
+    args = parser.parse_args()
+    shards = args.shards or args.processes
+    if shards < args.processes:
+        parser.error("need at least one shard per process")
+
+    slices = shard_slices(shards, args.processes)
+    children = {i: (spawn(i, shard_ids, shards), time.monotonic()) for i, shard_ids in enumerate(slices)}
+    backoff = {i: RESTART_BACKOFF for i in children}
+    restart_at = {}
+    try:
+        while True:
+            time.sleep(1)
+            now = time.monotonic()
+            for i, (child, started) in children.items():
+                if i in restart_at or child.poll() is None:
+                    continue
+                # A process that stayed up for a while gets a fresh backoff
+                if now - started > RESTART_BACKOFF_MAX:
+                    backoff[i] = RESTART_BACKOFF
+                logging.warning(f"Process {i} exited with {child.returncode}, restarting in {backoff[i]}s")
+                restart_at[i] = now + backoff[i]
+                backoff[i] = min(backoff[i] * 2, RESTART_BACKOFF_MAX)
+            for i, when in list(restart_at.items()):
+                if now >= when:
+                    del restart_at[i]
+                    children[i] = (spawn(i, slices[i], shards), now)
+    except KeyboardInterrupt:
+        for child, _ in children.values():
+            child.terminate()
+        for child, _ in children.values():
+            child.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import logging
+import os
+
+import discord
+
+from caching import LRUTTLCache
+from telemetry import log_event
+
+DIRECTORY_MAX_GUILDS = int(os.environ.get("DIRECTORY_MAX_GUILDS", "5000"))
+DIRECTORY_MAX_MEMBERS = int(os.environ.get("DIRECTORY_MAX_MEMBERS", "50000"))
+DIRECTORY_TTL = float(os.environ.get("DIRECTORY_TTL", "3600"))
+
+
+class GuildDirectory:
+    """Per-guild alias and member cache.
+
+    Aliases are warmed in one read on startup and kept current by the alias
+    command; members are kept current by gateway member events. Both tiers are
+    bounded by size and TTL so anything missed is eventually re-read.
+    """
+
+    def __init__(self, store, max_guilds: int = DIRECTORY_MAX_GUILDS,
+                 max_members: int = DIRECTORY_MAX_MEMBERS, ttl: float = DIRECTORY_TTL):
+        self.store = store
+        # guild ID -> {alias: user ID}
+        self._aliases = LRUTTLCache(max_guilds, ttl)
+        # (guild ID, user ID) -> discord.Member
+        self._members = LRUTTLCache(max_members, ttl)
+
+    async def warm(self, guild_ids: list[int]):
+        # One read of every guild's aliases instead of one per share
+        all_aliases = await self.store.all_aliases()
+        for guild_id in guild_ids:
+            self._aliases.set(guild_id, all_aliases.get(guild_id, {}))
+        logging.info(f"Warmed aliases for {len(guild_ids)} guilds")
+
+    async def get_aliases(self, guild_id: int) -> dict:
+        aliases = self._aliases.get(guild_id)
+        if aliases is None:
+            aliases = await self.store.get_aliases(guild_id)
+            self._aliases.set(guild_id, aliases)
+        return dict(aliases)
+
+    async def set_alias(self, guild_id: int, user_id: int, alias: str):
+        await self.store.set_alias(guild_id, user_id, alias)
+        aliases = self._aliases.get(guild_id)
+        if aliases is not None:
+            aliases = {a: u for a, u in aliases.items() if u != user_id}
+            aliases[alias] = user_id
+            self._aliases.set(guild_id, aliases)
+
+    def member_updated(self, member: discord.Member):
+        self._members.set((member.guild.id, member.id), member)
+
+    def member_removed(self, guild_id: int, user_id: int):
+        self._members.pop((guild_id, user_id))
+
+    async def find_member(self, guild: discord.Guild, user_id) -> discord.Member | None:
+        """Search by user ID"""
+        try:
+            user_id = int(user_id)
+        except ValueError:
+            return None
+        member = guild.get_member(user_id) or self._members.get((guild.id, user_id))
+        if member:
+            return member
+
+        # If not in cache, try fetching directly (requires member intent)
+        try:
+            member = await guild.fetch_member(user_id)
+            self.member_updated(member)
+            return member
+        except discord.NotFound:
+            log_event("member_not_found", logging.DEBUG, user=user_id)
+            return None
+        except discord.HTTPException as e:
+            logging.error(f"Error fetching member: {e}")
+            return None
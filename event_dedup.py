@@ -0,0 +1,41 @@
+import logging
+import os
+
+from caching import LRUTTLCache
+from telemetry import log_event, metrics
+
+# How long a handled event is remembered, comfortably longer than a gateway resume replays
+EVENT_DEDUP_TTL = float(os.environ.get("EVENT_DEDUP_TTL", "3600"))
+EVENT_DEDUP_MEMORY_ENTRIES = int(os.environ.get("EVENT_DEDUP_MEMORY_ENTRIES", "50000"))
+
+
+class EventDeduplicator:
+    """Lets each gateway event be handled once across every bot process.
+
+    Keys are claimed in the ledger store, which all processes share, so a
+    replayed or doubly delivered event is dropped no matter which process
+    sees it. Recent keys are also cached locally to skip the store for
+    duplicates arriving at the same process.
+    """
+
+    def __init__(self, store, ttl: float = EVENT_DEDUP_TTL, memory_entries: int = EVENT_DEDUP_MEMORY_ENTRIES):
+        self.store = store
+        self.ttl = ttl
+        self._seen = LRUTTLCache(memory_entries, ttl)
+
+    async def claim(self, key: str) -> bool:
+        if self._seen.get(key):
+            duplicate = True
+        else:
+            # Marked locally before the store round trip so concurrent duplicates can't both get through
+            self._seen.set(key, True)
+            try:
+                duplicate = not await self.store.claim_event(key, self.ttl)
+            except Exception as e:
+                # Handling an event twice is better than dropping it
+                logging.error(f"Could not claim event {key}: {e}")
+                duplicate = False
+        if duplicate:
+            metrics.count("duplicate_events")
+            log_event("duplicate_event", logging.DEBUG, key=key)
+        return not duplicate
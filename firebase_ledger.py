@@ -0,0 +1,376 @@
+import asyncio
+import logging
+import os
+import re
+import time
+import uuid
+
+from item_index import ItemMessage
+from ledger import LedgerOp, LedgerStore
+from split_engine import add_unique, to_cents
+
+# Characters Firebase does not allow in keys
+INVALID_KEY_CHARS = re.compile(r"[.$#\[\]/\x00-\x1f\x7f]")
+
+
+def item_key(item: str) -> str:
+    # Deterministic child key for an item within a bill; the prefix stops Firebase treating bills as arrays
+    return "i_" + INVALID_KEY_CHARS.sub("_", item)[:500]
+
+
+def _entries(node) -> list[tuple]:
+    if node is None:
+        return []
+    if isinstance(node, list):
+        return [(str(i), v) for i, v in enumerate(node) if v is not None]
+    return list(node.items())
+
+
+def _values(node) -> list:
+    # Firebase returns numerically keyed children as lists and everything else as dicts
+    if node is None:
+        return []
+    if isinstance(node, list):
+        return [v for v in node if v is not None]
+    return list(node.values())
+
+
+def _bill_cents(bill) -> int:
+    return sum(to_cents(entry['price']) for entry in _values(bill))
+
+
+# Top-level nodes that are not guild ledgers
+RESERVED_NODES = {"aliases", "balances", "bills", "item_messages", "processed_events", "versions"}
+
+
+class FirebaseLedger(LedgerStore):
+    """Debt ledger stored in the Firebase Realtime Database.
+
+    Raw items live under /{guild}/{debtor}/{creditor}/{msg_id}. Running totals
+    in cents are kept alongside them under /balances/{guild}/{debtor} as
+    {"total": cents, "creditors": {creditor: cents}} so balance queries are a
+    single small read no matter how long the history is, and
+    /bills/{guild}/{msg_id}/{debtor}/{creditor} indexes which pairs a bill
+    touched so it can be deleted without scanning the guild.
+
+    Each flushed batch is written as a single multi-path update keyed by item
+    name rather than a rewrite of the bill. /versions/{guild} gets a new
+    random token after every change, once balances are settled, so readers
+    can tell when their cached view of a guild went stale.
+
+    Guilds whose items were written before running totals existed have no
+    /balances node. The first read or write of such a guild rebuilds it from
+    the raw items, so existing debts keep showing up without a manual
+    $rebuild_balances.
+    """
+
+    def __init__(self, firebase):
+        super().__init__()
+        self.firebase = firebase
+        self._pruned_event_bucket = None
+        # Guilds whose /balances node is known to be in place
+        self._balances_checked = set()
+        self._balances_lock = asyncio.Lock()
+
+    @classmethod
+    def from_environment(cls):
+        # Firebase setup, only done when this backend is selected
+        import firebase_admin
+        from async_services import FirebaseService
+
+        if not firebase_admin._apps:
+            cred_obj = firebase_admin.credentials.Certificate(os.environ.get("GOOGLE_APPLICATION_CREDENTIALS"))
+            firebase_admin.initialize_app(cred_obj, {
+                'databaseURL': os.environ.get("FIREBASE_DATABASE_URL")
+            })
+        return cls(FirebaseService())
+
+    async def _touch(self, guild_ids):
+        await self.firebase.update('/', {f'versions/{guild_id}': uuid.uuid4().hex for guild_id in set(guild_ids)})
+
+    async def change_token(self, guild_id: int):
+        return await self.firebase.get(f'/versions/{guild_id}')
+
+    async def _ensure_balances(self, guild_ids):
+        pending = set(guild_ids) - self._balances_checked
+        if not pending:
+            return
+        # Held through the rebuild so no write lands between reading the items and replacing the totals
+        async with self._balances_lock:
+            for guild_id in pending - self._balances_checked:
+                if await self.firebase.get(f'/balances/{guild_id}') is None:
+                    mismatches = await self.rebuild_balances(guild_id)
+                    if mismatches:
+                        logging.info(f"Built running totals for guild {guild_id} from its items, {len(mismatches)} pairs")
+                self._balances_checked.add(guild_id)
+
+    async def _adjust_balance(self, guild_id: int, debtor_id: int, deltas: dict):
+        # Atomically apply {creditor_id: delta_cents} to the debtor's running totals
+        deltas = {str(creditor): cents for creditor, cents in deltas.items() if cents}
+        if not deltas:
+            return
+
+        def apply(current):
+            current = current or {}
+            creditors = current.get('creditors') or {}
+            for creditor, cents in deltas.items():
+                creditors[creditor] = creditors.get(creditor, 0) + cents
+                if creditors[creditor] == 0:
+                    del creditors[creditor]
+            return {'total': current.get('total', 0) + sum(deltas.values()), 'creditors': creditors}
+
+        await self.firebase.transaction(f'/balances/{guild_id}/{debtor_id}', apply)
+
+    async def _write_batch(self, ops: list[LedgerOp]) -> list:
+        """Apply a batch of item mutations as one multi-path update.
+
+        Every touched bill is read once so removals can find their child key and
+        balance deltas are exact, then all item writes, deletions and bill index
+        entries go out together. Items are keyed by name within a bill, so
+        replaying an add or remove is a no-op.
+        """
+        await self._ensure_balances(op.guild_id for op in ops)
+        bills = list(dict.fromkeys((op.guild_id, op.debtor_id, op.creditor_id, op.msg_id) for op in ops))
+        snapshots = await asyncio.gather(*(self.firebase.get('/{}/{}/{}/{}'.format(*bill)) for bill in bills))
+        state = {bill: dict(_entries(snapshot)) for bill, snapshot in zip(bills, snapshots)}
+
+        updates = {}
+        deltas = {}
+        results = []
+        for op in ops:
+            bill = (op.guild_id, op.debtor_id, op.creditor_id, op.msg_id)
+            entries = state[bill]
+            if op.kind == 'add':
+                key = item_key(op.item)
+                previous = entries.get(key)
+                entries[key] = {'item': op.item, 'price': op.price}
+                delta = to_cents(op.price) - (to_cents(previous['price']) if previous else 0)
+                result = None
+            else:
+                key = next((k for k, entry in entries.items() if entry.get('item') == op.item), None)
+                if key is None:
+                    results.append(None)
+                    continue
+                result = entries.pop(key)
+                delta = -to_cents(result['price'])
+            updates['{}/{}/{}/{}/{}'.format(*bill, key)] = entries.get(key)
+            debtor_deltas = deltas.setdefault((op.guild_id, op.debtor_id), {})
+            debtor_deltas[op.creditor_id] = debtor_deltas.get(op.creditor_id, 0) + delta
+            results.append(result)
+
+        for (guild_id, debtor_id, creditor_id, msg_id), entries in state.items():
+            updates[f'bills/{guild_id}/{msg_id}/{debtor_id}/{creditor_id}'] = True if entries else None
+
+        await self.firebase.update('/', updates)
+        await asyncio.gather(*(
+            self._adjust_balance(guild_id, debtor_id, creditor_deltas)
+            for (guild_id, debtor_id), creditor_deltas in deltas.items()
+        ))
+        await self._touch(op.guild_id for op in ops)
+        return results
+
+    async def remove_bill(self, guild_id: int, msg_id: int):
+        # Function to remove entire bill from ledger using the bill index
+        logging.info(f"Removing bill {msg_id} from ledger")
+        await self._ensure_balances([guild_id])
+        index = await self.firebase.get(f'/bills/{guild_id}/{msg_id}')
+        if not index:
+            # Bills written before the index existed have to be found by scanning
+            await self._remove_bill_by_scan(guild_id, msg_id)
+            await self._touch([guild_id])
+            return
+
+        pairs = [(debtor_id, creditor_id) for debtor_id, creditors in index.items() for creditor_id in creditors]
+        bills = await asyncio.gather(*(
+            self.firebase.get(f'/{guild_id}/{debtor_id}/{creditor_id}/{msg_id}') for debtor_id, creditor_id in pairs
+        ))
+        updates = {f'{guild_id}/{debtor_id}/{creditor_id}/{msg_id}': None for debtor_id, creditor_id in pairs}
+        updates[f'bills/{guild_id}/{msg_id}'] = None
+        await self.firebase.update('/', updates)
+
+        deltas = {}
+        for (debtor_id, creditor_id), bill in zip(pairs, bills):
+            deltas.setdefault(debtor_id, {})[creditor_id] = -_bill_cents(bill)
+        await asyncio.gather(*(
+            self._adjust_balance(guild_id, debtor_id, creditor_deltas) for debtor_id, creditor_deltas in deltas.items()
+        ))
+        await self._touch([guild_id])
+
+    async def _remove_bill_by_scan(self, guild_id: int, msg_id: int):
+        snapshot = await self.firebase.get(f'/{guild_id}')
+        if snapshot:
+            for user_id, creditors in snapshot.items():
+                if user_id not in RESERVED_NODES:  # Skip index nodes
+                    for creditor_id, bills in creditors.items():
+                        if str(msg_id) in bills:
+                            await self.firebase.delete(f'/{guild_id}/{user_id}/{creditor_id}/{msg_id}')
+                            await self._adjust_balance(guild_id, user_id, {creditor_id: -_bill_cents(bills[str(msg_id)])})
+
+    async def backfill_bill_index(self, guild_id: int) -> int:
+        # Migration: index every existing bill in the guild, returns the number of bills indexed
+        snapshot = await self.firebase.get(f'/{guild_id}') or {}
+        index = {}
+        for debtor_id, creditors in snapshot.items():
+            if debtor_id in RESERVED_NODES:
+                continue
+            for creditor_id, bills in creditors.items():
+                for msg_id in (bills or {}):
+                    index.setdefault(str(msg_id), {}).setdefault(str(debtor_id), {})[str(creditor_id)] = True
+        if index:
+            await self.firebase.update(f'/bills/{guild_id}', index)
+        return len(index)
+
+    async def bill_items(self, guild_id: int, msg_id: int) -> list[LedgerOp]:
+        index = await self.firebase.get(f'/bills/{guild_id}/{msg_id}') or {}
+        pairs = [(int(debtor_id), int(creditor_id)) for debtor_id, creditors in index.items() for creditor_id in creditors]
+        bills = await asyncio.gather(*(
+            self.firebase.get(f'/{guild_id}/{debtor_id}/{creditor_id}/{msg_id}') for debtor_id, creditor_id in pairs
+        ))
+        return [
+            LedgerOp('add', guild_id, debtor_id, creditor_id, msg_id, entry['item'], entry['price'])
+            for (debtor_id, creditor_id), bill in zip(pairs, bills)
+            for entry in _values(bill)
+        ]
+
+    async def pair_debt(self, guild_id: int, debtor_id: int, creditor_id: int) -> float:
+        # Function to fetch a user's debt to a specified creditor
+        await self._ensure_balances([guild_id])
+        cents = await self.firebase.get(f'/balances/{guild_id}/{debtor_id}/creditors/{creditor_id}')
+        return (cents or 0) / 100
+
+    async def total_debt(self, guild_id: int, debtor_id: int) -> float:
+        # Function to fetch a user's total debt in a server
+        await self._ensure_balances([guild_id])
+        cents = await self.firebase.get(f'/balances/{guild_id}/{debtor_id}/total')
+        return (cents or 0) / 100
+
+    async def guild_debts(self, guild_id: int) -> list[tuple]:
+        # Function to list every outstanding (debtor, creditor, cents) pair in a server from the running totals
+        await self._ensure_balances([guild_id])
+        balances = await self.firebase.get(f'/balances/{guild_id}') or {}
+        return [
+            (int(debtor_id), int(creditor_id), cents)
+            for debtor_id, balance in balances.items()
+            for creditor_id, cents in ((balance or {}).get('creditors') or {}).items()
+        ]
+
+    async def rebuild_balances(self, guild_id: int, verify_only: bool = False) -> list[tuple]:
+        """Recompute running totals from raw items.
+
+        Returns (debtor, creditor, stored_cents, actual_cents) for every pair that
+        was out of sync, and rewrites /balances/{guild} unless verify_only is set.
+        """
+        snapshot = await self.firebase.get(f'/{guild_id}') or {}
+        stored = await self.firebase.get(f'/balances/{guild_id}') or {}
+
+        balances = {}
+        for debtor_id, creditors in snapshot.items():
+            if debtor_id in RESERVED_NODES:
+                continue
+            pairs = {}
+            for creditor_id, bills in creditors.items():
+                cents = sum(_bill_cents(bill) for bill in _values(bills))
+                if cents:
+                    pairs[str(creditor_id)] = cents
+            if pairs:
+                balances[str(debtor_id)] = {'total': sum(pairs.values()), 'creditors': pairs}
+
+        mismatches = []
+        for debtor_id in set(balances) | set(stored):
+            actual = balances.get(debtor_id, {}).get('creditors', {})
+            recorded = (stored.get(debtor_id) or {}).get('creditors') or {}
+            for creditor_id in set(actual) | set(recorded):
+                if actual.get(creditor_id, 0) != recorded.get(creditor_id, 0):
+                    mismatches.append((debtor_id, creditor_id, recorded.get(creditor_id, 0), actual.get(creditor_id, 0)))
+            actual_total = balances.get(debtor_id, {}).get('total', 0)
+            recorded_total = (stored.get(debtor_id) or {}).get('total', 0)
+            if actual_total != recorded_total:
+                mismatches.append((debtor_id, 'total', recorded_total, actual_total))
+
+        if mismatches and not verify_only:
+            await self.firebase.set(f'/balances/{guild_id}', balances)
+            await self._touch([guild_id])
+        return mismatches
+
+    async def get_aliases(self, guild_id: int) -> dict:
+        snapshot = await self.firebase.get(f'/aliases/{guild_id}') or {}
+        return {alias: int(user_id) for user_id, alias in snapshot.items()}
+
+    async def all_aliases(self) -> dict:
+        snapshot = await self.firebase.get('/aliases') or {}
+        return {
+            int(guild_id): {alias: int(user_id) for user_id, alias in (aliases or {}).items()}
+            for guild_id, aliases in snapshot.items()
+        }
+
+    async def set_alias(self, guild_id: int, user_id: int, alias: str):
+        await self.firebase.update('/', {
+            f'aliases/{guild_id}/{user_id}': alias,
+            f'versions/{guild_id}': uuid.uuid4().hex,
+        })
+
+    async def record_item_messages(self, entries: list[ItemMessage]):
+        if entries:
+            await self.firebase.update('/', {
+                f'item_messages/{entry.guild_id}/{entry.msg_id}': {
+                    'item': entry.item,
+                    'price': entry.price,
+                    'creditor': entry.creditor_id,
+                }
+                for entry in entries
+            })
+
+    async def lookup_item_message(self, guild_id: int, msg_id: int) -> ItemMessage | None:
+        data = await self.firebase.get(f'/item_messages/{guild_id}/{msg_id}')
+        if data is None:
+            return None
+        return ItemMessage(guild_id, msg_id, data['item'], float(data['price']), int(data['creditor']))
+
+    async def claim_event(self, key: str, ttl: float) -> bool:
+        # Keys are grouped in ttl-long buckets so whole expired buckets can be dropped in one delete
+        bucket = int(time.time() // ttl)
+        if await self.firebase.get(f'/processed_events/{bucket - 1}/{key}') is not None:
+            return False
+        claimed = False
+
+        def mark(current):
+            nonlocal claimed
+            claimed = current is None
+            return True
+
+        await self.firebase.transaction(f'/processed_events/{bucket}/{key}', mark)
+        if self._pruned_event_bucket != bucket:
+            self._pruned_event_bucket = bucket
+            await self.firebase.delete(f'/processed_events/{bucket - 2}')
+        return claimed
+
+    async def export(self):
+        root = await self.firebase.get('/') or {}
+        items = []
+        for guild_id, debtors in root.items():
+            if guild_id in RESERVED_NODES:
+                continue
+            for debtor_id, creditors in (debtors or {}).items():
+                for creditor_id, bills in (creditors or {}).items():
+                    for msg_id, bill in _entries(bills):
+                        # Legacy bills are lists that can repeat a name (one "shared receipt" per photo),
+                        # number the repeats so stores keyed by item name keep every entry
+                        names = {}
+                        for entry in _values(bill):
+                            item = add_unique(names, entry['item'], entry['price'])
+                            items.append(LedgerOp('add', int(guild_id), int(debtor_id), int(creditor_id), int(msg_id),
+                                                  item, entry['price']))
+        aliases = [
+            (int(guild_id), int(user_id), alias)
+            for guild_id, guild_aliases in (root.get('aliases') or {}).items()
+            for user_id, alias in (guild_aliases or {}).items()
+        ]
+        item_messages = [
+            ItemMessage(int(guild_id), int(msg_id), data['item'], float(data['price']), int(data['creditor']))
+            for guild_id, messages in (root.get('item_messages') or {}).items()
+            for msg_id, data in (messages or {}).items()
+        ]
+        return items, aliases, item_messages
+
+    def close(self):
+        self.firebase.shutdown()
@@ -0,0 +1,90 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+PREPROCESS_ENABLED = os.environ.get("PREPROCESS_ENABLED", "1") != "0"
+PREPROCESS_MAX_EDGE = int(os.environ.get("PREPROCESS_MAX_EDGE", "1600"))
+PREPROCESS_JPEG_QUALITY = int(os.environ.get("PREPROCESS_JPEG_QUALITY", "85"))
+PREPROCESS_WORKERS = int(os.environ.get("PREPROCESS_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Bump whenever the pipeline changes output so cached parses of old payloads are not reused
+PREPROCESS_VERSION = 1
+
+_executor = None
+
+
+def _otsu_threshold(histogram: list[int]) -> int:
+    # Threshold that best separates the bright receipt paper from the background
+    total = sum(histogram)
+    weighted_total = sum(i * count for i, count in enumerate(histogram))
+    background = weighted_background = 0
+    best_threshold, best_variance = 128, 0.0
+    for i, count in enumerate(histogram):
+        background += count
+        if background == 0:
+            continue
+        foreground = total - background
+        if foreground == 0:
+            break
+        weighted_background += i * count
+        mean_background = weighted_background / background
+        mean_foreground = (weighted_total - weighted_background) / foreground
+        variance = background * foreground * (mean_background - mean_foreground) ** 2
+        if variance > best_variance:
+            best_threshold, best_variance = i, variance
+    return best_threshold
+
+
+def crop_to_receipt(image: Image.Image, margin: float = 0.02) -> Image.Image:
+    """Crop to the bounding box of the bright region, i.e. the receipt paper.
+
+    The crop is skipped when it would remove almost nothing or would keep only
+    a sliver, both of which mean the photo doesn't look like paper on a table.
+    """
+    gray = image if image.mode == "L" else image.convert("L")
+    small = gray.copy()
+    small.thumbnail((256, 256))
+    threshold = _otsu_threshold(small.histogram()[:256])
+    bbox = small.point(lambda v: 255 if v > threshold else 0).getbbox()
+    if not bbox:
+        return image
+
+    scale_x = image.width / small.width
+    scale_y = image.height / small.height
+    pad_x = image.width * margin
+    pad_y = image.height * margin
+    left = max(0, int(bbox[0] * scale_x - pad_x))
+    top = max(0, int(bbox[1] * scale_y - pad_y))
+    right = min(image.width, int(bbox[2] * scale_x + pad_x))
+    bottom = min(image.height, int(bbox[3] * scale_y + pad_y))
+
+    kept = (right - left) * (bottom - top) / (image.width * image.height)
+    if kept > 0.9 or kept < 0.15:
+        return image
+    return image.crop((left, top, right, bottom))
+
+
+def preprocess_receipt(image_bytes: bytes, max_edge: int = PREPROCESS_MAX_EDGE,
+                       quality: int = PREPROCESS_JPEG_QUALITY) -> bytes:
+    # Function to shrink a receipt photo to what the vision model needs, returns JPEG bytes
+    image = Image.open(BytesIO(image_bytes))
+    image = ImageOps.exif_transpose(image)
+    image = image.convert("L")
+    image = ImageOps.autocontrast(image, cutoff=1)
+    image = crop_to_receipt(image)
+    image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+    output = BytesIO()
+    image.save(output, format="JPEG", quality=quality, optimize=True)
+    return output.getvalue()
+
+
+async def preprocess_receipt_async(image_bytes: bytes, max_edge: int = PREPROCESS_MAX_EDGE) -> bytes:
+    # Runs preprocessing on a worker pool so decoding large photos never blocks the event loop.
+    # Threads are enough here because Pillow releases the GIL while decoding, resampling and encoding.
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=PREPROCESS_WORKERS, thread_name_prefix="preprocess")
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, preprocess_receipt, image_bytes, max_edge)
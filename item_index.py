@@ -0,0 +1,45 @@
+import os
+from typing import NamedTuple
+
+from caching import LRUTTLCache
+
+ITEM_INDEX_MEMORY_ENTRIES = int(os.environ.get("ITEM_INDEX_MEMORY_ENTRIES", "20000"))
+
+
+class ItemMessage(NamedTuple):
+    guild_id: int
+    msg_id: int
+    item: str
+    price: float
+    creditor_id: int
+
+
+class ItemMessageIndex:
+    """Maps react-mode item message IDs to what they are selling.
+
+    Entries are persisted in the ledger store when the item messages are
+    posted and cached in a bounded LRU, so reaction events can be handled from
+    the gateway payload alone.
+    """
+
+    def __init__(self, store, memory_entries: int = ITEM_INDEX_MEMORY_ENTRIES):
+        self.store = store
+        self._memory = LRUTTLCache(memory_entries)
+
+    def remember(self, entry: ItemMessage):
+        self._memory.set((entry.guild_id, entry.msg_id), entry)
+
+    async def record(self, entries: list[ItemMessage]):
+        # Cache immediately so reactions racing the write still resolve, then persist in one write
+        for entry in entries:
+            self.remember(entry)
+        await self.store.record_item_messages(entries)
+
+    async def lookup(self, guild_id: int, msg_id: int) -> ItemMessage | None:
+        cached = self._memory.get((guild_id, msg_id))
+        if cached is not None:
+            return cached
+        entry = await self.store.lookup_item_message(guild_id, msg_id)
+        if entry is not None:
+            self.remember(entry)
+        return entry
@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import os
+from abc import ABC, abstractmethod
+from typing import NamedTuple
+
+from item_index import ItemMessage
+
+# Reaction events arriving within this many seconds are written in one update
+LEDGER_FLUSH_WINDOW = float(os.environ.get("LEDGER_FLUSH_WINDOW", "0.05"))
+LEDGER_MAX_BATCH = int(os.environ.get("LEDGER_MAX_BATCH", "500"))
+
+# Which store backs the ledger: "firebase" or "sqlite"
+LEDGER_BACKEND = os.environ.get("LEDGER_BACKEND", "firebase")
+LEDGER_SQLITE_PATH = os.environ.get("LEDGER_SQLITE_PATH", "ledger.sqlite3")
+
+class LedgerOp(NamedTuple):
+    kind: str  # "add" or "remove"
+    guild_id: int
+    debtor_id: int
+    creditor_id: int
+    msg_id: int
+    item: str
+    price: float = 0.0
+
+
+class LedgerStore(ABC):
+    """Storage backend for the ledger, aliases and react-mode item messages.
+
+    Item mutations are queued and flushed in small batches through
+    _write_batch, so bursts of reactions cost one backend write per window.
+    Amounts are kept in cents for balances; raw items keep the price they
+    were recorded with.
+    """
+
+    def __init__(self):
+        self._pending = []
+        self._flush_task = None
+
+    async def add_item(self, guild_id: int, debtor_id: int, creditor_id: int, msg_id: int, item: str, price: float):
+        # Function to add item and price to the ledger
+        await self.submit(LedgerOp('add', guild_id, debtor_id, creditor_id, msg_id, item, price))
+
+    async def remove_item(self, guild_id: int, debtor_id: int, creditor_id: int, msg_id: int, item: str):
+        # Function to remove item from the ledger, returns the removed entry if there was one
+        return await self.submit(LedgerOp('remove', guild_id, debtor_id, creditor_id, msg_id, item))
+
+    async def apply(self, ops: list[LedgerOp]) -> list:
+        # Submit several mutations at once so they share a flush
+        return await asyncio.gather(*(self.submit(op) for op in ops))
+
+    async def submit(self, op: LedgerOp):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((op, future))
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_soon())
+        return await future
+
+    async def _flush_soon(self):
+        # Coalesce everything that arrives within the window, keep flushing until the queue drains
+        while self._pending:
+            if len(self._pending) < LEDGER_MAX_BATCH:
+                await asyncio.sleep(LEDGER_FLUSH_WINDOW)
+            batch, self._pending = self._pending[:LEDGER_MAX_BATCH], self._pending[LEDGER_MAX_BATCH:]
+            try:
+                results = await self._write_batch([op for op, _ in batch])
+            except Exception as e:
+                logging.error(f"Ledger flush of {len(batch)} ops failed: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for (_, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+
+    @abstractmethod
+    async def _write_batch(self, ops: list[LedgerOp]) -> list:
+        """Apply ops in order, returning None for adds and the removed entry (or None) for removes."""
+
+    @abstractmethod
+    async def remove_bill(self, guild_id: int, msg_id: int):
+        """Delete every item recorded under a bill message, for all debtors."""
+
+    @abstractmethod
+    async def bill_items(self, guild_id: int, msg_id: int) -> list[LedgerOp]:
+        """Every item recorded under a bill message, as add ops."""
+
+    @abstractmethod
+    async def pair_debt(self, guild_id: int, debtor_id: int, creditor_id: int) -> float:
+        """How much debtor owes creditor in a server."""
+
+    @abstractmethod
+    async def total_debt(self, guild_id: int, debtor_id: int) -> float:
+        """How much debtor owes in total in a server."""
+
+    @abstractmethod
+    async def guild_debts(self, guild_id: int) -> list[tuple]:
+        """Every outstanding (debtor, creditor, cents) pair in a server."""
+
+    @abstractmethod
+    async def rebuild_balances(self, guild_id: int, verify_only: bool = False) -> list[tuple]:
+        """Recompute running totals from raw items, returning the (debtor, creditor, stored, actual) mismatches."""
+
+    async def backfill_bill_index(self, guild_id: int) -> int:
+        # Stores that index bills natively have nothing to backfill
+        return 0
+
+    @abstractmethod
+    async def get_aliases(self, guild_id: int) -> dict:
+        """{alias: user ID} for a server."""
+
+    @abstractmethod
+    async def all_aliases(self) -> dict:
+        """{guild ID: {alias: user ID}} for every server."""
+
+    @abstractmethod
+    async def set_alias(self, guild_id: int, user_id: int, alias: str):
+        """Set a user's alias in a server, replacing any previous one."""
+
+    @abstractmethod
+    async def record_item_messages(self, entries: list[ItemMessage]):
+        """Persist react-mode item messages."""
+
+    @abstractmethod
+    async def lookup_item_message(self, guild_id: int, msg_id: int) -> ItemMessage | None:
+        """The item message with this ID, if it is one."""
+
+    @abstractmethod
+    async def change_token(self, guild_id: int):
+        """A cheap marker that changes whenever the server's items, balances or aliases do, for read caches."""
+
+    @abstractmethod
+    async def claim_event(self, key: str, ttl: float) -> bool:
+        """Mark an event as handled, False if it already was within the last ttl seconds."""
+
+    @abstractmethod
+    async def export(self) -> tuple[list[LedgerOp], list[tuple], list[ItemMessage]]:
+        """Everything in the store as (item add ops, (guild, user, alias) rows, item messages), for migrations."""
+
+    def close(self):
+        pass
+
+
+def open_store(backend: str = LEDGER_BACKEND, sqlite_path: str = LEDGER_SQLITE_PATH) -> LedgerStore:
+    # Backends are imported lazily so a SQLite deployment never touches Firebase setup
+    if backend == "firebase":
+        from firebase_ledger import FirebaseLedger
+
+        return FirebaseLedger.from_environment()
+    if backend == "sqlite":
+        from sqlite_ledger import SQLiteLedger
+
+        return SQLiteLedger(sqlite_path)
+    raise ValueError(f"Unknown ledger backend {backend!r}, expected 'firebase' or 'sqlite'")
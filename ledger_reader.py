@@ -0,0 +1,75 @@
+import os
+import time
+from collections import defaultdict
+
+from caching import LRUTTLCache
+from settlement import net_balances, settle
+
+# Seconds a guild's cached reads are trusted before its change token is checked again
+LEDGER_READ_RECHECK = float(os.environ.get("LEDGER_READ_RECHECK", "2"))
+LEDGER_READ_MAX_GUILDS = int(os.environ.get("LEDGER_READ_MAX_GUILDS", "1000"))
+
+
+class LedgerReader:
+    """Cached read-only queries over a ledger store, for clients like the MCP server.
+
+    Reads are cached per guild alongside the store's change token for that
+    guild. Once the recheck window has passed, the next read fetches the token
+    and drops the guild's cache if it moved, so a write made by the bot shows
+    up after at most one window. Balances, pair debts and settlements are all
+    answered from one cached copy of the guild's running totals.
+    """
+
+    def __init__(self, store, recheck: float = LEDGER_READ_RECHECK, max_guilds: int = LEDGER_READ_MAX_GUILDS):
+        self.store = store
+        self.recheck = recheck
+        # guild ID -> {"token", "checked", "data": {query key: result}}
+        self._guilds = LRUTTLCache(max_guilds)
+
+    async def _cached(self, guild_id: int, key, load):
+        entry = self._guilds.get(guild_id)
+        now = time.monotonic()
+        if entry is None or now - entry["checked"] >= self.recheck:
+            # The token is read before any data, so a write racing the load only causes an extra refresh
+            token = await self.store.change_token(guild_id)
+            if entry is None or entry["token"] != token:
+                entry = {"token": token, "data": {}}
+                self._guilds.set(guild_id, entry)
+            entry["checked"] = now
+        if key not in entry["data"]:
+            entry["data"][key] = await load()
+        return entry["data"][key]
+
+    async def debts(self, guild_id: int) -> dict:
+        # {(debtor, creditor): cents} for every outstanding pair
+        async def load():
+            return {(debtor, creditor): cents for debtor, creditor, cents in await self.store.guild_debts(guild_id)}
+
+        return await self._cached(guild_id, "debts", load)
+
+    async def balances(self, guild_id: int, user_ids: list[int]) -> dict:
+        # {user: {"owes", "owed", "net"}} in dollars, net is positive when the user is owed money
+        owes, owed = defaultdict(int), defaultdict(int)
+        for (debtor, creditor), cents in (await self.debts(guild_id)).items():
+            owes[debtor] += cents
+            owed[creditor] += cents
+        return {
+            user_id: {"owes": owes[user_id] / 100, "owed": owed[user_id] / 100, "net": (owed[user_id] - owes[user_id]) / 100}
+            for user_id in user_ids
+        }
+
+    async def pair_debts(self, guild_id: int, pairs: list[tuple[int, int]]) -> list[float]:
+        debts = await self.debts(guild_id)
+        return [debts.get((debtor, creditor), 0) / 100 for debtor, creditor in pairs]
+
+    async def bill(self, guild_id: int, msg_id: int) -> list:
+        return await self._cached(guild_id, ("bill", msg_id), lambda: self.store.bill_items(guild_id, msg_id))
+
+    async def aliases(self, guild_id: int) -> dict:
+        return await self._cached(guild_id, "aliases", lambda: self.store.get_aliases(guild_id))
+
+    async def settlement(self, guild_id: int) -> list[tuple]:
+        async def load():
+            return settle(net_balances([(d, c, cents) for (d, c), cents in (await self.debts(guild_id)).items()]))
+
+        return await self._cached(guild_id, "settlement", load)
@@ -0,0 +1,74 @@
+"""Copy the ledger, aliases and item messages from one storage backend to another.
+
+    python migrate_store.py firebase sqlite --sqlite-path ledger.sqlite3
+
+Balances and the bill index are rebuilt by the target as the items are
+written, then checked against the raw items and against the source's debts
+for every migrated server. Repeated item names within a legacy bill are
+numbered on export, so no entry is merged away.
+"""
+import argparse
+import asyncio
+import logging
+
+from dotenv import load_dotenv, find_dotenv
+
+from ledger import LedgerStore, open_store
+
+
+async def migrate(source: LedgerStore, target: LedgerStore) -> int:
+    items, aliases, item_messages = await source.export()
+    logging.info(f"Copying {len(items)} items, {len(aliases)} aliases and {len(item_messages)} item messages")
+
+    await target.apply(items)
+    for guild_id, user_id, alias in aliases:
+        await target.set_alias(guild_id, user_id, alias)
+    await target.record_item_messages(item_messages)
+
+    failures = 0
+    for guild_id in sorted({op.guild_id for op in items}):
+        mismatches = await target.rebuild_balances(guild_id, verify_only=True)
+        if mismatches:
+            failures += 1
+            logging.error(f"Guild {guild_id}: {len(mismatches)} balances do not match the migrated items")
+            continue
+        # Every pair has to owe the same in both stores, or items were lost or merged on the way
+        expected = {(debtor, creditor): cents for debtor, creditor, cents in await source.guild_debts(guild_id)}
+        actual = {(debtor, creditor): cents for debtor, creditor, cents in await target.guild_debts(guild_id)}
+        differing = [pair for pair in expected.keys() | actual.keys() if expected.get(pair, 0) != actual.get(pair, 0)]
+        if differing:
+            failures += 1
+            debtor, creditor = differing[0]
+            logging.error(
+                f"Guild {guild_id}: {len(differing)} debts differ from the source, e.g. {debtor} owes {creditor} "
+                f"{expected.get(differing[0], 0)} cents in the source and {actual.get(differing[0], 0)} in the target"
+            )
+    return failures
+
+
+def main():
+    load_dotenv(find_dotenv())
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", choices=["firebase", "sqlite"])
+    parser.add_argument("target", choices=["firebase", "sqlite"])
+    parser.add_argument("--sqlite-path", default="ledger.sqlite3")
+    args = parser.parse_args()
+    if args.source == args.target:
+        parser.error("source and target must be different backends")
+
+    async def run():
+        source = open_store(args.source, sqlite_path=args.sqlite_path)
+        target = open_store(args.target, sqlite_path=args.sqlite_path)
+        try:
+            return await migrate(source, target)
+        finally:
+            source.close()
+            target.close()
+
+    failures = asyncio.run(run())
+    raise SystemExit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
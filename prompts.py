@@ -0,0 +1,81 @@
+from pydantic import BaseModel
+
+# Bump whenever RECEIPT_PROMPT changes so cached parses are not reused
+RECEIPT_PROMPT_VERSION = 2
+
+class ReceiptItem(BaseModel):
+    name: str
+    price: float
+
+class ReceiptOutput(BaseModel):
+    items: list[ReceiptItem]
+    total: float
+
+RECEIPT_PROMPT = """Here is a photo of a receipt. List every item with its name and its cost including taxes and other fees listed if applicable, such that all of the prices add up to the total at the bottom of the receipt, and give that total (without any tip) as "total". Do not stack items. If an item is listed multiple times, list each instance of the item separately with a number appended to the end of the name. If an item has a quantity greater than 1, split it into multiple items with the same name and append a number to the end of each instance of the item. Ignore any items that are not food or drink, such as "cash" or "change". If there is a tip listed, ignore it. If there is a tax listed, include it in the price of the items. If there is no tax listed, assume that the prices already include tax. If there are any discounts or coupons listed, subtract them from the total and distribute the discount evenly across all items. Do not include any items that are not food or drink. Here is the receipt image:"""
+
+def RECEIPT_REPAIR_FORMAT_PROMPT(output, error):
+    return f"""
+        This was supposed to be a JSON object with a list of receipt "items", each with a "name" and a "price", and the receipt "total":
+        {output}
+        It could not be read because: {error}
+        Return the same items and total as valid JSON. Do not add, remove or change any items.
+    """
+
+def RECEIPT_REPAIR_TOTAL_PROMPT(items, total):
+    return f"""
+        These items were read from the receipt in the photo below: {items}. They add up to ${sum(items.values()):.2f}, but the total read from the receipt is ${total:.2f}.
+        Look at the receipt again and find the mistake, such as a missed or duplicated item, a misread price, or tax or discounts not spread over the items. Keep the items that were read correctly.
+        Return the full corrected list of items and the total at the bottom of the receipt (without any tip). Here is the receipt image:
+    """
+
+class Share(BaseModel):
+    user: str
+    amount: float
+
+class SplitOutput(BaseModel):
+    shares: list[Share]
+    explanation: str
+
+def ACTOR_PROMPT(pre_tip, notes, diners, aliases_dict):
+    return f"""
+        You are a bill-splitting assistant for a Discord server.
+        Here is a JSON object representing the items ordered at a restaurant and their prices including tax and tip: {pre_tip}. Here are some additional notes on how the order was split: {notes}. The diners' IDs are: {diners}. Assume that unspecified items are split between all diners.
+        List how much each person who ordered owes as "shares", with the person as "user" and the total amount they owe as "amount". Substitute all aliases with their Discord ID using this dictionary: {aliases_dict}, and use the diners' ID if there is no known alias for them. Do not make duplicate calls for the same user, and make sure all aliases have been looked up.
+        Make sure that the sum of all the amounts is equal to the total of the items, and all diners are included in the shares unless the notes specifiy otherwise.
+        Explain your reasoning in "explanation".
+    """
+
+def ACTOR_PROMPT_CORRECTION(pre_tip, notes, diners, critic_explanation, aliases_dict, previous_split=None):
+    return f"""
+        You are a bill-splitting assistant for a Discord server.
+        Here is a JSON object representing the items ordered at a restaurant and their prices including tax and tip: {pre_tip}. Here are some additional notes on how the order was split: {notes}. The diners' IDs are: {diners}. Assume that unspecified items are split between all diners.
+        This is the previous split: {previous_split}. Here is the reasoning as to why it is incorrect: {critic_explanation}.
+        List the correct distribution of costs as "shares", with the person as "user" and the amount they owe as "amount". Substitute all aliases with their Discord ID using this dictionary: {aliases_dict}, and use placeholder IDs for any unknown users. Do not make duplicate calls for the same user, and make sure all aliases have been looked up.
+        Make sure that the sum of all the amounts is equal to the total of the items, and all diners are included in the shares unless the notes specifiy otherwise.
+        Explain your reasoning in "explanation".
+    """
+
+class CriticOutput(BaseModel):
+    is_correct: bool
+    explanation: str
+    
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+def CRITIC_PROMPT(pre_tip, notes, diners, per_person, explanation, aliases_dict):
+    return f"""
+        Approach this as a logic problem.
+        I am given a list of items in a receipt after tax: {pre_tip}, and some additional notes on how the order was split: {notes}. If there are no notes, assume all items were shared equally. The diners' IDs are: {diners}.
+        I have a JSON object representing how much each person owes for the bill: {per_person}. This is my explanation of how I arrived at these totals: {explanation}
+        Your task is to ensure that the JSON object with tax has the bill split according to the notes given, and that the sum of all diners' payments after tip is equal to the original total. Make sure all of the listed diners are included in the JSON object, unless the notes specifiy otherwise.
+        Use this dictionary to substitute all aliases with their Discord ID if needed: {aliases_dict}.
+        Elaborate on why it is correct or incorrect with respect to my explanation. You may ignore negligible rounding errors of up to 1 cent. 
+        
+        Return your results as a JSON with two keys: "is_correct" which is true or false, and "explanation" which is your reasoning. It may look like 
+        <example-output>
+        {{
+            "is_correct": false,
+            "explanation": "The total amount owed does not match the receipt total. User 123456789 is missing from the split."
+        }}  
+        </example-output>
+    """
@@ -1,17 +1,32 @@
-import json
+import asyncio
 import os
-from io import BytesIO
+import time
 import discord
-from PIL import Image
 from discord.ext import commands
 from discord.ui import Button, View
 from dotenv import load_dotenv, find_dotenv
-import firebase_admin
 from google import genai
-from firebase_admin import db
+from google.genai import types
 import logging
 
-from pydantic import BaseModel
+from async_services import GenAIService
+from caching import LRUTTLCache, ReceiptCache
+from directory import GuildDirectory
+from pydantic import ValidationError
+from prompts import (
+    ACTOR_PROMPT, ACTOR_PROMPT_CORRECTION, CRITIC_PROMPT, RECEIPT_PROMPT, RECEIPT_PROMPT_VERSION,
+    RECEIPT_REPAIR_FORMAT_PROMPT, RECEIPT_REPAIR_TOTAL_PROMPT, CriticOutput, ReceiptItem, ReceiptOutput, SplitOutput,
+)
+from image_preprocess import PREPROCESS_ENABLED, PREPROCESS_MAX_EDGE, PREPROCESS_VERSION, preprocess_receipt_async
+from item_index import ItemMessage, ItemMessageIndex
+from ledger import LedgerOp, open_store
+from streaming import JsonArrayStream
+from settlement import net_balances, settle as settle_debts
+from split_engine import LLM_DEADLINE_SECONDS, MAX_LLM_ROUNDS, add_unique, apply_tip, reconcile_total, split_bill, tip_fraction, to_cents
+from event_dedup import EventDeduplicator
+from send_queue import BULK, SendQueue
+from telemetry import bind, log_event, metrics
+from worker_pool import WorkerPool
 
 load_dotenv(find_dotenv())
 
@@ -28,68 +43,52 @@ intents.message_content = True
 intents.reactions = True
 intents.members = True
 
-load_dotenv(find_dotenv())
+# Every message the bot posts goes through per-channel send queues
+outbox = SendQueue()
 
-intents = discord.Intents.default()
-intents.message_content = True
-bot = commands.Bot(command_prefix='$', intents=intents)
-bot.remove_command('help')
+# Shards this process runs. Unset means discord.py picks the shard count and this process runs all of them,
+# cluster.py sets both to split the shards across several processes.
+SHARD_COUNT = int(os.environ["SHARD_COUNT"]) if os.environ.get("SHARD_COUNT") else None
+SHARD_IDS = [int(shard) for shard in os.environ["SHARD_IDS"].split(",")] if os.environ.get("SHARD_IDS") else None
 
-# Firebase setup
-cred_obj = firebase_admin.credentials.Certificate(os.environ.get("GOOGLE_APPLICATION_CREDENTIALS"))
-default_app = firebase_admin.initialize_app(cred_obj, {
-    'databaseURL': os.environ.get("FIREBASE_DATABASE_URL")
-})
+# Every REST request is counted and timed against the guild and command that made it,
+# and message responses keep the send queues' rate-limit buckets up to date
+bot = commands.AutoShardedBot(
+    command_prefix='$', intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS,
+    http_trace=metrics.rest_trace(outbox.observe_response),
+)
+bot.remove_command('help')
 
 # LLM setup
 client = genai.Client(api_key=os.environ.get("GENAI_API_KEY"))
 MODEL = "gemini-2.5-flash"
 
-RECEIPT_PROMPT = """Here is a photo of a receipt. Create a JSON object where the keys are the names of the items and the values are the cost of the item including taxes and other fees listed if applicable such that all of the values add up to the total at the bottom of the receipt. Do not stack items. If an item is listed multiple times, make a new key for each instance of the item with a number appended to the end of the name. If an item has a quantity greater than 1, split it into multiple items with the same name and append a number to the end of each instance of the item. Ignore any items that are not food or drink, such as "cash" or "change". If there is a tip listed, ignore it. If there is a tax listed, include it in the price of the items. If there is no tax listed, assume that the prices already include tax. If there are any discounts or coupons listed, subtract them from the total and distribute the discount evenly across all items. Do not include any items that are not food or drink in the JSON object. Here is the receipt image:"""
-
-def ACTOR_PROMPT(pre_tip, notes, diners, aliases_dict):
-    return f"""
-        You are a bill-splitting assistant for a Discord server.
-        Here is a JSON object representing the items ordered at a restaurant and their prices including tax and tip: {pre_tip}. Here are some additional notes on how the order was split: {notes}. The diners' IDs are: {diners}. Assume that unspecified items are split between all diners.
-        Create a new JSON object where the keys are the names of the people who ordered and the values are the total amount each person owes. Substitute all aliases with their Discord ID using this dictionary: {aliases_dict}, and use the diners' ID if there is no known alias for them. Do not make duplicate calls for the same user, and make sure all aliases have been looked up.
-        Make sure that the sum of all the values is equal to the total at the bottom of the receipt, and all diners are included in the JSON object unless the notes specifiy otherwise.
-        Explain your reasoning and add it as an item in the JSON object with the key "explanation".
-    """
-
-def ACTOR_PROMPT_CORRECTION(pre_tip, notes, diners, critic_explanation, aliases_dict):
-    return f"""
-        You are a bill-splitting assistant for a Discord server.
-        Here is an incorrect JSON object representing the items ordered at a restaurant and their prices including tax and tip: {pre_tip}. Here are some additional notes on how the order was split: {notes}. The diners' IDs are: {diners}. Assume that unspecified items are split between all diners.
-        Here is the reasoning as to why the JSON object is incorrect: {critic_explanation}.
-        Create a new JSON object to represent the correct distribution of costs. Substitute all aliases with their Discord ID using this dictionary: {aliases_dict}, and use placeholder IDs for any unknown users. Do not make duplicate calls for the same user, and make sure all aliases have been looked up.
-        Make sure that the sum of all the values is equal to the total at the bottom of the receipt, and all diners are included in the JSON object unless the notes specifiy otherwise.
-        Explain your reasoning and add it as an item in the JSON object with the key "explanation".
-    """
-
-class CriticOutput(BaseModel):
-    is_correct: bool
-    explanation: str
-    
-    def __getitem__(self, key):
-        return getattr(self, key)
-
-def CRITIC_PROMPT(pre_tip, notes, diners, per_person, explanation, aliases_dict):
-    return f"""
-        Approach this as a logic problem.
-        I am given a list of items in a receipt after tax: {pre_tip}, and some additional notes on how the order was split: {notes}. If there are no notes, assume all items were shared equally. The diners' IDs are: {diners}.
-        I have a JSON object representing how much each person owes for the bill: {per_person}. This is my explanation of how I arrived at these totals: {explanation}
-        Your task is to ensure that the JSON object with tax has the bill split according to the notes given, and that the sum of all diners' payments after tip is equal to the original total. Make sure all of the listed diners are included in the JSON object, unless the notes specifiy otherwise.
-        Use this dictionary to substitute all aliases with their Discord ID if needed: {aliases_dict}.
-        Elaborate on why it is correct or incorrect with respect to my explanation. You may ignore negligible rounding errors of up to 1 cent. 
-        
-        Return your results as a JSON with two keys: "is_correct" which is true or false, and "explanation" which is your reasoning. It may look like 
-        <example-output>
-        {{
-            "is_correct": false,
-            "explanation": "The total amount owed does not match the receipt total. User 123456789 is missing from the split."
-        }}  
-        </example-output>
-    """
+# Structured output schemas, so responses are typed JSON instead of text to be sliced apart
+RECEIPT_CONFIG = {"response_mime_type": "application/json", "response_schema": ReceiptOutput}
+SPLIT_CONFIG = {"response_mime_type": "application/json", "response_schema": SplitOutput}
+# Extra prompts allowed to fix a receipt parse that is malformed or doesn't add up to its total
+RECEIPT_REPAIR_ROUNDS = int(os.environ.get("RECEIPT_REPAIR_ROUNDS", "2"))
+
+# Async I/O layer so LLM and database calls never block the gateway
+llm = GenAIService(client, MODEL)
+# Ledger storage backend, chosen with LEDGER_BACKEND (firebase or sqlite)
+ledger = open_store()
+item_index = ItemMessageIndex(ledger)
+receipt_cache = ReceiptCache()
+directory = GuildDirectory(ledger)
+# Commands and interactions are handled once even if the gateway delivers them twice
+dedup = EventDeduplicator(ledger)
+
+# Bot messages known not to be item messages, so reactions on them cost nothing
+NON_ITEM_MESSAGE_ENTRIES = int(os.environ.get("NON_ITEM_MESSAGE_ENTRIES", "10000"))
+non_item_messages = LRUTTLCache(NON_ITEM_MESSAGE_ENTRIES)
+
+# Receipt attachments processed at once, in total and per server, and how many may wait for a worker
+RECEIPT_MAX_CONCURRENCY = int(os.environ.get("RECEIPT_MAX_CONCURRENCY", "8"))
+RECEIPT_GUILD_CONCURRENCY = int(os.environ.get("RECEIPT_GUILD_CONCURRENCY", "3"))
+RECEIPT_QUEUE_SIZE = int(os.environ.get("RECEIPT_QUEUE_SIZE", "100"))
+receipt_pool = WorkerPool("receipt", RECEIPT_MAX_CONCURRENCY, RECEIPT_QUEUE_SIZE)
+guild_semaphores = {}
 
 class ShareDeleteButton(View):
     def __init__(self, referred_message_id: int, ctx):
@@ -99,372 +98,702 @@ class ShareDeleteButton(View):
 
     @discord.ui.button(label="Delete", style=discord.ButtonStyle.danger, custom_id="delete_button")
     async def delete_button(self, interaction: discord.Interaction, button: Button):
+        bind(interaction.guild_id, "delete_bill")
         await interaction.message.delete()
-        # logging.info(f"Deleting bill {self.referred_message_id} from ledger")
-        await remove_share_bill(self.referred_message_id, self.ctx.guild)
+        log_event("bill_deleted", bill=self.referred_message_id, user=interaction.user.id)
+        with metrics.span("ledger"):
+            await ledger.remove_bill(self.ctx.guild.id, self.referred_message_id)
+
+async def send_react_message(ctx, item: str, price: float) -> ItemMessage:
+    # Function to send one item message with reaction options and make it claimable right away
+    # Item messages are bulk output and each needs its own message ID, so they are never merged
+    message = await outbox.reply(ctx, f"Item: {item}, Price: ${price:.2f}.", priority=BULK, mergeable=False, mention_author=False)
+    entry = ItemMessage(ctx.guild.id, message.id, item, price, ctx.message.author.id)
+    item_index.remember(entry)
+    return entry
 
 async def send_react_messages(dues, ctx):
     # Function to send messages for each item in the receipt with reaction options
-    for item in dues.keys():
-        price = dues[item]
-        await ctx.reply(f"Item: {item}, Price: ${price:.2f}.", mention_author=False)
+    # Everything is queued at once, the channel's send queue posts them in order as fast as the rate limit allows
+    entries = await asyncio.gather(*(send_react_message(ctx, item, price) for item, price in dues.items()))
+    await item_index.record(list(entries))
+
+# Discord allows 25 options per select menu and 5 action rows per message
+PICKER_OPTIONS_PER_SELECT = 25
+PICKER_SELECTS_PER_MESSAGE = 5
+
+def picker_items(select: discord.ui.Select) -> dict:
+    # Option value -> (item name, price), the label is the name recorded in the ledger and the value carries the cents
+    return {option.value: (option.label, int(option.value.split(":")[1]) / 100) for option in select.options}
+
+async def update_claims(interaction: discord.Interaction, creditor_id: int, msg_id: int, select: discord.ui.Select, replace: bool) -> dict:
+    # Function to record a user's picks from one menu against what the ledger already has for them,
+    # returns every item they now claim from that menu with its price
+    menu_items = picker_items(select)
+    names = dict(menu_items.values())
+    picked = {menu_items[value][0] for value in select.values}
+    guild_id, user_id = interaction.guild_id, interaction.user.id
+    with metrics.span("ledger"):
+        recorded = await ledger.bill_items(guild_id, msg_id)
+        previous = {op.item for op in recorded if op.debtor_id == user_id and op.item in names}
+        # The shared menu only adds, only a user's own pre-filled menu says what they no longer claim
+        current = picked if replace else previous | picked
+        ops = [
+            LedgerOp('add', guild_id, user_id, creditor_id, msg_id, item, names[item])
+            for item in current - previous
+        ] + [
+            LedgerOp('remove', guild_id, user_id, creditor_id, msg_id, item)
+            for item in previous - current
+        ]
+        await ledger.apply(ops)
+    log_event("items_claimed", user=user_id, added=len(current - previous), removed=len(previous - current))
+    return {item: names[item] for item in current}
+
+async def send_claims(interaction: discord.Interaction, creditor_id: int, msg_id: int, select: discord.ui.Select, claimed: dict):
+    # Function to show a user what they claim from a menu, with their own copy of it to change that
+    if claimed:
+        summary = ", ".join(f"{item} (${price:.2f})" for item, price in sorted(claimed.items()))
+        content = f"You claimed: {summary}. Change your items from this menu below."
+    else:
+        content = "You have no items claimed from this menu. Pick them below."
+    view = View(timeout=None)
+    view.add_item(ClaimEditSelect(creditor_id, msg_id, select.options, claimed))
+    await interaction.followup.send(content, view=view, ephemeral=True)
+
+async def start_claim(interaction: discord.Interaction, creditor_id: int) -> bool:
+    # Shared checks for both kinds of menu, defers the response when the claim should go ahead
+    bind(interaction.guild_id, "pick_claim")
+    if not await dedup.claim(f"interaction:{interaction.id}"):
+        return False
+    if interaction.user.id == creditor_id:
+        await interaction.response.send_message("You paid for this receipt.", ephemeral=True)
+        return False
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    return True
+
+class ItemSelect(discord.ui.DynamicItem[discord.ui.Select], template=r"receipt_picker:(?P<creditor_id>\d+):(?P<index>\d+)"):
+    """One select menu of a receipt picker, shared by everyone who sees the message.
+
+    Picks made here are added to what the user already claims, since the menu
+    can't show each user their own earlier picks. The reply carries a
+    ClaimEditSelect pre-filled from the ledger for unclaiming. Everything a
+    claim needs is on the posted message: the payer and menu position in the
+    custom ID, the item names and prices in the options, and earlier claims in
+    the ledger, so menus keep working after a restart.
+    """
 
-async def parse_reaction_message(message):
-    msg_id = message.id
-    # logging.info("Price: " + message.content.split(", Price: $")[1][:-1])
-    price = float(message.content.split(", Price: $")[1][:-1])
-    item = message.content.split(", Price: $")[0].split("Item: ")[1]
-    original_msg = await message.channel.fetch_message(message.reference.message_id)
-    creditor = original_msg.author
-    guild = message.guild
-    return msg_id, item, price, creditor, guild
-
-async def read_receipt(image: discord.Attachment):
-    # Function to parse receipt image and return a dictionary of items and prices
-    image_bytes = await image.read()
-    receipt_image = Image.open(BytesIO(image_bytes))
-
-    response = client.models.generate_content(
-        model=MODEL, contents=[RECEIPT_PROMPT, receipt_image]
-    )
-    # logging.info(f"LLM Response: {response.text[response.text.find('{'):response.text.rfind('}') + 1]}")  # Log the LLM response for debugging
-    items = json.loads(response.text[response.text.find('{'):response.text.rfind('}') + 1])
-    return items
+    def __init__(self, creditor_id: int, index: int, options: list[discord.SelectOption], placeholder: str | None = None):
+        super().__init__(discord.ui.Select(
+            custom_id=f"receipt_picker:{creditor_id}:{index}",
+            placeholder=placeholder,
+            min_values=0,
+            max_values=len(options),
+            options=options,
+        ))
+        self.creditor_id = creditor_id
+
+    @classmethod
+    def for_items(cls, creditor_id: int, index: int, items: list[tuple[str, float]], first: int):
+        options = [
+            discord.SelectOption(label=item[:100], value=f"{i}:{to_cents(price)}", description=f"${price:.2f}")
+            for i, (item, price) in enumerate(items)
+        ]
+        return cls(creditor_id, index, options, f"Items {first + 1}-{first + len(items)}: pick what you had")
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Select, match):
+        # Rebuilt from the message the menu was used on
+        return cls(int(match["creditor_id"]), int(match["index"]), item.options, item.placeholder)
+
+    async def callback(self, interaction: discord.Interaction):
+        if not await start_claim(interaction, self.creditor_id):
+            return
+        claimed = await update_claims(interaction, self.creditor_id, interaction.message.id, self.item, replace=False)
+        await send_claims(interaction, self.creditor_id, interaction.message.id, self.item, claimed)
 
-async def get_aliases_dict(ctx) -> dict:
-    ref = db.reference(f'/aliases/{ctx.guild.id}')
-    snapshot = ref.get()
-    if snapshot:
-        aliases_dict = {v: k for k, v in snapshot.items()}
-        # logging.info(f"Aliases dict: {aliases_dict}")  # Log the aliases dictionary for debugging
-        return aliases_dict
-    else:
-        await ctx.reply("No aliases found in the database for this server.")
-
-async def find_user_by_id(guild: discord.Guild, user_id: int) -> discord.Member | None:
-    """Search by user ID"""
-    member = guild.get_member(user_id)
-    if member:
-        return member
-    
-    # If not in cache, try fetching directly (requires member intent)
+class ClaimEditSelect(discord.ui.DynamicItem[discord.ui.Select], template=r"receipt_claims:(?P<creditor_id>\d+):(?P<msg_id>\d+)"):
+    """A user's own copy of a picker menu, sent ephemerally with their claims pre-selected.
+
+    Each submission is the user's full selection for the menu, so anything
+    left unselected is unclaimed. The picker message ID is in the custom ID,
+    since the interaction comes from the ephemeral message.
+    """
+
+    def __init__(self, creditor_id: int, msg_id: int, options: list[discord.SelectOption], claimed=()):
+        options = [
+            discord.SelectOption(label=option.label, value=option.value, description=option.description,
+                                 default=option.label in claimed)
+            for option in options
+        ]
+        super().__init__(discord.ui.Select(
+            custom_id=f"receipt_claims:{creditor_id}:{msg_id}",
+            placeholder="Your items from this menu",
+            min_values=0,
+            max_values=len(options),
+            options=options,
+        ))
+        self.creditor_id = creditor_id
+        self.msg_id = msg_id
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Select, match):
+        return cls(int(match["creditor_id"]), int(match["msg_id"]), item.options)
+
+    async def callback(self, interaction: discord.Interaction):
+        if not await start_claim(interaction, self.creditor_id):
+            return
+        claimed = await update_claims(interaction, self.creditor_id, self.msg_id, self.item, replace=True)
+        await send_claims(interaction, self.creditor_id, self.msg_id, self.item, claimed)
+
+# Picker menus posted before a restart are dispatched by their custom IDs
+bot.add_dynamic_items(ItemSelect, ClaimEditSelect)
+
+class ItemPickerView(View):
+    """Select menus covering a page of receipt items."""
+
+    def __init__(self, items: list[tuple[str, float]], first: int, creditor_id: int):
+        super().__init__(timeout=None)
+        for index, start in enumerate(range(0, len(items), PICKER_OPTIONS_PER_SELECT)):
+            self.add_item(ItemSelect.for_items(creditor_id, index, items[start:start + PICKER_OPTIONS_PER_SELECT], first + start))
+
+async def send_item_picker(dues, ctx):
+    # Function to post every item of the receipt as select menus in as few messages as possible
+    items = list(dues.items())
+    per_message = PICKER_OPTIONS_PER_SELECT * PICKER_SELECTS_PER_MESSAGE
+    for start in range(0, len(items), per_message):
+        page = items[start:start + per_message]
+        view = ItemPickerView(page, start, ctx.message.author.id)
+        await outbox.reply(
+            ctx,
+            f"Receipt items {start + 1}-{start + len(page)} of {len(items)}. Pick the items you had.",
+            view=view, mention_author=False,
+        )
+
+async def parse_reaction_message(payload: discord.RawReactionActionEvent) -> ItemMessage | None:
+    # Fallback for item messages posted before the item index existed
+    channel = bot.get_channel(payload.channel_id)
+    if not channel:
+        logging.error(f"Could not find channel {payload.channel_id}")
+        return None
     try:
-        member = await guild.fetch_member(user_id)
-        return member
+        message = await channel.fetch_message(payload.message_id)
     except discord.NotFound:
-        # logging.info(f"Member with ID {user_id} not found in guild {guild.name}")
+        logging.error(f"Message {payload.message_id} not found")
+        return None
+    if message.author != bot.user or not message.reference or ", Price: $" not in message.content:
         return None
-    except discord.HTTPException as e:
-        logging.error(f"Error fetching member: {e}")
+    price = float(message.content.split(", Price: $")[1][:-1])
+    item = message.content.split(", Price: $")[0].split("Item: ")[1]
+    original_msg = await channel.fetch_message(message.reference.message_id)
+    log_event("legacy_item_message", logging.DEBUG, message=message.id, item=item, price=price)
+    return ItemMessage(payload.guild_id, message.id, item, price, original_msg.author.id)
+
+async def resolve_item_message(payload: discord.RawReactionActionEvent) -> ItemMessage | None:
+    # Function to find the receipt item a reaction refers to, from the index whenever possible
+    key = (payload.guild_id, payload.message_id)
+    if non_item_messages.get(key):
         return None
+    # Add events carry the message author, so reactions on other people's messages cost nothing
+    author_id = getattr(payload, "message_author_id", None)
+    if author_id is not None and author_id != bot.user.id:
+        return None
+    entry = await item_index.lookup(payload.guild_id, payload.message_id)
+    if entry is None:
+        entry = await parse_reaction_message(payload)
+        if entry is None:
+            non_item_messages.set(key, True)
+            return None
+        await item_index.record([entry])
+    return entry
+
+async def read_receipt(ctx, image: discord.Attachment, on_item=None):
+    # Function to parse receipt image and return a dictionary of items and prices.
+    # on_item(item, price) is awaited for each item as soon as it has been streamed back.
+    with metrics.span("download"):
+        image_bytes = await image.read()
+    version = RECEIPT_PROMPT_VERSION
+    if PREPROCESS_ENABLED:
+        version = f"{RECEIPT_PROMPT_VERSION}/{PREPROCESS_VERSION}/{PREPROCESS_MAX_EDGE}"
+    cache_key = ReceiptCache.key(image_bytes, MODEL, version)
+    with metrics.span("cache"):
+        items = await receipt_cache.get(cache_key)
+    if items is not None:
+        log_event("receipt_cache_hit", items=len(items))
+        if on_item:
+            for item, price in items.items():
+                await on_item(item, price)
+        return items
+    if PREPROCESS_ENABLED:
+        with metrics.span("preprocess"):
+            receipt_image = types.Part.from_bytes(data=await preprocess_receipt_async(image_bytes), mime_type="image/jpeg")
+    else:
+        receipt_image = types.Part.from_bytes(data=image_bytes, mime_type=image.content_type or "image/jpeg")
+
+    text = ""
+    parser = JsonArrayStream("items")
+    streamed = {}
+    with metrics.span("vision"):
+        async for chunk in llm.generate_content_stream([RECEIPT_PROMPT, receipt_image], config=RECEIPT_CONFIG):
+            if not chunk.text:
+                continue
+            text += chunk.text
+            for element in parser.feed(chunk.text):
+                try:
+                    item = ReceiptItem.model_validate(element)
+                except ValidationError:
+                    continue  # Left to the full parse
+                name = add_unique(streamed, item.name, item.price)
+                if on_item:
+                    await on_item(name, item.price)
+    log_event("receipt_response", logging.DEBUG, response=text)
+    items, reconciled = await check_receipt(text, receipt_image, streamed, on_item)
+    log_event("receipt_parsed", items=len(items), total=round(sum(items.values()), 2))
+    if reconciled:
+        await receipt_cache.set(cache_key, items)
+    else:
+        # Not cached, so sending the receipt again gets a fresh parse instead of the same mistake
+        await outbox.reply(
+            ctx,
+            f"The items read from {image.filename} add up to ${sum(items.values()):.2f}, which doesn't match the total "
+            "printed on the receipt. Check them before claiming, or send the receipt again to re-read it.",
+        )
+    return items
+
+async def check_receipt(text: str, receipt_image, streamed: dict, on_item=None) -> tuple[dict, bool]:
+    # Function to validate a receipt parse against its schema and printed total, repairing it with
+    # at most RECEIPT_REPAIR_ROUNDS targeted prompts instead of re-running the whole parse.
+    # Returns the items and whether they add up to the printed total.
+    items = streamed
+    for attempt in range(RECEIPT_REPAIR_ROUNDS + 1):
+        try:
+            receipt = ReceiptOutput.model_validate_json(text[text.find('{'):text.rfind('}') + 1])
+        except ValidationError as e:
+            # Malformed output only needs the JSON fixed, which is a cheap text-only prompt
+            reason = "format"
+            contents = [RECEIPT_REPAIR_FORMAT_PROMPT(text, e.errors()[0]['msg'])]
+        else:
+            items = {}
+            for item in receipt.items:
+                add_unique(items, item.name, item.price)
+            if on_item:
+                # Items missing from the stream (cut off or malformed) still get posted
+                for name, price in items.items():
+                    if name not in streamed:
+                        streamed[name] = price
+                        await on_item(name, price)
+            reconciled = reconcile_total(items, receipt.total)
+            if reconciled is not None:
+                # Posted prices stand, a cent of rounding isn't worth editing the item messages
+                return (streamed if on_item else reconciled), True
+            if on_item:
+                # Streamed items are already posted, so they can't be swapped for a corrected list
+                break
+            # The parsed items go back with the photo, so the model only has to find what doesn't add up
+            reason = "total"
+            contents = [RECEIPT_REPAIR_TOTAL_PROMPT(items, receipt.total), receipt_image]
+        if attempt == RECEIPT_REPAIR_ROUNDS:
+            break
+        metrics.count("receipt_repairs", reason=reason)
+        log_event("receipt_repair", logging.WARNING, reason=reason, attempt=attempt + 1)
+        with metrics.span("repair"):
+            response = await llm.generate_content(contents, config=RECEIPT_CONFIG)
+        text = response.text
+
+    if on_item:
+        items = streamed
+    if not items:
+        raise ValueError("Could not read any items from the receipt")
+    metrics.count("receipt_unreconciled")
+    log_event("receipt_unreconciled", logging.WARNING, items=len(items), total=round(sum(items.values()), 2))
+    return items, False
 
 async def query_llm(ctx, pre_tip: dict, members: list[discord.Member], tip: str, notes: str):
-    # Function to query the LLM with a prompt and return the response
+    # Function to split the bill, using the LLM only for notes the local splitter can't parse
     diners = [member.id for member in members]
-    aliases_dict = await get_aliases_dict(ctx)
+    aliases_dict = await directory.get_aliases(ctx.guild.id)
+    log_event("aliases_loaded", logging.DEBUG, aliases=aliases_dict)
+
+    with metrics.span("split_local"):
+        per_person = split_bill(pre_tip, notes, diners, aliases_dict, tip)
+    if per_person is not None:
+        log_event("split_local", diners=len(diners))
+        return per_person
+
     correct = False
     critic_explanation = ""
+    per_person = {}
 
     try:
-        while not correct:
-            # Send second prompt to split the bill
-            if critic_explanation:
-                contents = [ACTOR_PROMPT_CORRECTION(pre_tip, notes, diners, critic_explanation, aliases_dict)]
-            else:
-                contents = [ACTOR_PROMPT(pre_tip, notes, diners, aliases_dict)]
-            actor_response = client.models.generate_content(
-                model=MODEL, contents=contents,
-            )
-
-            actor_response_text = actor_response.text
-            # logging.info(f"Actor LLM Raw Response: {actor_response_text}")
-            # logging.info(f"Actor LLM Response: {actor_response_text[actor_response_text.find('{'):actor_response_text.rfind('}') + 1]}")  # Log the LLM response for debugging
-            result = json.loads(actor_response_text[actor_response_text.find('{'):actor_response_text.rfind('}') + 1])
-            actor_explanation = result.pop("explanation")
-            per_person = dict(result)
-
-            # Third prompt to verify correctness
-            critic_response = client.models.generate_content(
-                model=MODEL,
-                contents=[CRITIC_PROMPT(pre_tip, notes, diners, per_person, actor_explanation, aliases_dict)],
-                config={
-                    "response_mime_type": "application/json",
-                    "response_schema": CriticOutput,
-                }
-            )
-            
-            critic_result = critic_response.parsed
-            
-            critic_explanation = critic_result['explanation']
-            correct = critic_result['is_correct']
-
-            # logging.info(f"Critic LLM Response: {critic_explanation}")  # Log the critic's explanation for debugging
-
-
-        if tip[-1] != '%':
-            tip_percent = float(tip) / sum(float(v) for v in pre_tip.values())
-        else:
-            tip_percent = int(tip.strip('%')) / 100
-        for user in per_person:
-            per_person[user] = float(per_person[user]) * (1 + tip_percent)
-        return per_person
+        async with asyncio.timeout(LLM_DEADLINE_SECONDS):
+            for llm_round in range(MAX_LLM_ROUNDS):
+                # Send second prompt to split the bill
+                if critic_explanation:
+                    contents = [ACTOR_PROMPT_CORRECTION(pre_tip, notes, diners, critic_explanation, aliases_dict, per_person)]
+                else:
+                    contents = [ACTOR_PROMPT(pre_tip, notes, diners, aliases_dict)]
+                with metrics.span("actor"):
+                    actor_response = await llm.generate_content(contents, config=SPLIT_CONFIG)
+                log_event("actor_response", logging.DEBUG, round=llm_round, response=actor_response.text)
+
+                # Splits that are malformed or don't add up are sent back without spending a critic call
+                try:
+                    split = actor_response.parsed or SplitOutput.model_validate_json(actor_response.text)
+                except ValidationError as e:
+                    metrics.count("split_repairs", reason="format")
+                    critic_explanation = f"The output was not valid: {e.errors()[0]['msg']}."
+                    continue
+                actor_explanation = split.explanation
+                per_person = {}
+                for share in split.shares:
+                    per_person[share.user] = per_person.get(share.user, 0) + share.amount
+                reconciled = reconcile_total(per_person, sum(pre_tip.values()))
+                if reconciled is None:
+                    metrics.count("split_repairs", reason="total")
+                    critic_explanation = (
+                        f"The amounts add up to ${sum(per_person.values()):.2f}, "
+                        f"but the items add up to ${sum(pre_tip.values()):.2f}."
+                    )
+                    continue
+                per_person = reconciled
+
+                # Third prompt to verify correctness
+                with metrics.span("critic"):
+                    critic_response = await llm.generate_content(
+                        [CRITIC_PROMPT(pre_tip, notes, diners, per_person, actor_explanation, aliases_dict)],
+                        config={
+                            "response_mime_type": "application/json",
+                            "response_schema": CriticOutput,
+                        }
+                    )
+
+                critic_result = critic_response.parsed
+
+                critic_explanation = critic_result['explanation']
+                correct = critic_result['is_correct']
+
+                log_event("critic_verdict", round=llm_round, correct=correct, explanation=critic_explanation)
+                if correct:
+                    break
+                metrics.count("critic_rejections")
+
+        if not correct:
+            logging.warning(f"Critic rejected the split after {MAX_LLM_ROUNDS} rounds: {critic_explanation}")
+            await outbox.reply(ctx, "Could not produce a verified split. Please try again with clearer notes.")
+            return {}
+
+        return apply_tip(per_person, tip_fraction(tip, pre_tip))
+    except TimeoutError:
+        logging.error(f"Splitting timed out after {LLM_DEADLINE_SECONDS} seconds")
+        await outbox.reply(ctx, "Splitting the receipt took too long. Please try again.")
+        return {}
     except Exception as e:
         logging.error(f"Error querying LLM: {e}")
-        await ctx.reply("There was an error processing the receipt. Please try again.")
+        await outbox.reply(ctx, "There was an error processing the receipt. Please try again.")
         return {}
 
-async def add_to_ledger(msg_id: int, item: str, price: float, guild: discord.Guild, user: discord.Member, creditor: discord.Member):
-    # Function to add item and price to ledger.json
-    ref = db.reference(f'/{guild.id}/{user.id}/{creditor.id}/{msg_id}')
-    
-    # Get existing items for this msg_id
-    existing_data = ref.get()
-    
-    if existing_data is None:
-        # First item for this message
-        items = [{
-            'item': item,
-            'price': price,
-        }]
-    else:
-        # Append to existing items
-        items = existing_data if isinstance(existing_data, list) else []
-        items.append({
-            'item': item,
-            'price': price,
-        })
-    
-    # Save the updated list
-    ref.set(items)
-
-async def remove_from_ledger(msg_id: int, item: str, guild: discord.Guild, user: discord.Member, creditor: discord.Member):
-    # Function to remove item and price from ledger.json
-    ref = db.reference(f'/{guild.id}/{user.id}/{creditor.id}/{msg_id}')
-    items = ref.get()
-    if items:
-        for i, item_data in enumerate(items):
-            if item_data.get('item') == item:
-                removed_item = items.pop(i)
-                
-                # Update the database
-                if len(items) == 0:
-                    ref.delete()
-                else:
-                    ref.set(items)
-                # logging.info(f"Removed item: {removed_item}")
-                return removed_item
-            
-async def remove_share_bill(msg_id: int, guild: discord.Guild):
-    # Function to remove entire bill from ledger
-    ref = db.reference(f'/{guild.id}')
-    logging.info(f"Removing bill {msg_id} from ledger")
-    snapshot = ref.get()
-    if snapshot:
-        for user_id, creditors in snapshot.items():
-            if user_id != "aliases":  # Skip aliases node
-                for creditor_id, bills in creditors.items():
-                    if str(msg_id) in bills:
-                        ref.child(f'{user_id}/{creditor_id}/{msg_id}').delete()
-                        # logging.info(f"Removed bill {msg_id} for user {user_id} from creditor {creditor_id}")
-
-async def fetch_user_user_debt(user: discord.Member, creditor: discord.Member, guild: discord.Guild) -> float:
-    # Function to fetch a user's debt to a specified creditor from Firebase
-    ref = db.reference(f'/{guild.id}/{user.id}/{creditor.id}')
-    snapshot = ref.get()
-    sum = 0.0
-    if snapshot:
-        for entry in snapshot.values():
-            for item in entry:
-                # logging.info(item)
-                sum += item['price']
-    return sum
-
-async def fetch_user_debt(user: discord.Member, guild: discord.Guild) -> float:
-    # Function to fetch a user's total debt in a server from Firebase
-    ref = db.reference(f'/{guild.id}/{user.id}')
-    snapshot = ref.get()
-    sum = 0.0
-    if snapshot:
-        for creditor_id, debts in snapshot.items():
-            for entry in debts.values():
-                for item in entry:
-                    # logging.info(item)
-                    sum += item['price']
-    return sum
+@bot.event
+async def on_ready():
+    await metrics.start_server()
+    await directory.warm([guild.id for guild in bot.guilds])
+
+@bot.before_invoke
+async def start_command_metrics(ctx):
+    # Commands run in their own task, so everything below is attributed to this guild and command
+    bind(ctx.guild.id if ctx.guild else None, ctx.command.name)
+    ctx.metrics_start = time.perf_counter()
+
+@bot.after_invoke
+async def finish_command_metrics(ctx):
+    status = "error" if ctx.command_failed else "ok"
+    metrics.count("commands", status=status)
+    metrics.observe("command", time.perf_counter() - ctx.metrics_start)
+    log_event("command", status=status, user=ctx.author.id)
+
+@bot.event
+async def on_message(message: discord.Message):
+    if message.author.bot:
+        return
+    ctx = await bot.get_context(message)
+    # Only commands are claimed, so ordinary chat costs no store round trip
+    if ctx.valid and await dedup.claim(f"message:{message.id}"):
+        await bot.invoke(ctx)
+
+@bot.event
+async def on_member_join(member: discord.Member):
+    directory.member_updated(member)
+
+@bot.event
+async def on_member_update(before: discord.Member, after: discord.Member):
+    directory.member_updated(after)
+
+@bot.event
+async def on_raw_member_remove(payload: discord.RawMemberRemoveEvent):
+    directory.member_removed(payload.guild_id, payload.user.id)
 
 @bot.event
 async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
-    # logging.info(f"Raw reaction event: User {payload.user_id} added {payload.emoji}")
-    
-    # Ignore bot's own reactions
-    if payload.user_id == bot.user.id:
+    # Ignore bot's own reactions and reactions outside servers
+    if payload.user_id == bot.user.id or payload.guild_id is None:
         return
-    
-    # Get the channel and message
-    channel = bot.get_channel(payload.channel_id)
-    if not channel:
-        logging.error(f"Could not find channel {payload.channel_id}")
+    bind(payload.guild_id, "reaction_add")
+    log_event("reaction", logging.DEBUG, user=payload.user_id, message=payload.message_id, emoji=payload.emoji)
+
+    with metrics.span("resolve"):
+        entry = await resolve_item_message(payload)
+    if entry is None:
         return
-    
-    try:
-        message = await channel.fetch_message(payload.message_id)
-    except discord.NotFound:
-        logging.error(f"Message {payload.message_id} not found")
+    if payload.user_id == entry.creditor_id:
+        log_event("reaction_ignored", logging.DEBUG, user=payload.user_id, reason="creditor")
         return
-    
-    # Check if message is from bot
-    if message.author == bot.user:
-        user = await bot.fetch_user(payload.user_id)
-        
-        # logging.info(f"Reaction added: {user.name} reacted to bot message")
-        
-        msg_id, item, price, creditor, guild = await parse_reaction_message(message)
-        # logging.info(f"Parsed: {item} - ${price} for {creditor.mention}")
-        if user.id == creditor.id:
-            # logging.info(f"Ignoring reaction: {user.name} is the creditor")
-            return
-        await add_to_ledger(msg_id, item, price, guild, user, creditor)
+    with metrics.span("ledger"):
+        await ledger.add_item(entry.guild_id, payload.user_id, entry.creditor_id, entry.msg_id, entry.item, entry.price)
+    metrics.count("commands", status="ok")
+    log_event("item_claimed", logging.DEBUG, user=payload.user_id, item=entry.item, price=entry.price)
 
 
 @bot.event
 async def on_raw_reaction_remove(payload: discord.RawReactionActionEvent):
-    # logging.info(f"Raw reaction remove event: User {payload.user_id} removed {payload.emoji}")
-    
-    # Ignore bot's own reactions
-    if payload.user_id == bot.user.id:
+    # Ignore bot's own reactions and reactions outside servers
+    if payload.user_id == bot.user.id or payload.guild_id is None:
         return
-    
-    # Get the channel and message
-    channel = bot.get_channel(payload.channel_id)
-    if not channel:
-        logging.error(f"Could not find channel {payload.channel_id}")
-        return
-    
-    try:
-        message = await channel.fetch_message(payload.message_id)
-    except discord.NotFound:
-        logging.error(f"Message {payload.message_id} not found")
+    bind(payload.guild_id, "reaction_remove")
+    log_event("reaction", logging.DEBUG, user=payload.user_id, message=payload.message_id, emoji=payload.emoji)
+
+    with metrics.span("resolve"):
+        entry = await resolve_item_message(payload)
+    if entry is None:
         return
-    
-    # Check if message is from bot
-    if message.author == bot.user:
-        user = await bot.fetch_user(payload.user_id)
-        
-        # logging.info(f"Reaction removed: {user.name} removed reaction from bot message")
-        
-        msg_id, item, price, creditor, guild = await parse_reaction_message(message)
-        # logging.info(f"Removing: {item} - ${price} for {creditor.mention}")
-        await remove_from_ledger(msg_id, item, guild, user, creditor)
+    with metrics.span("ledger"):
+        await ledger.remove_item(entry.guild_id, payload.user_id, entry.creditor_id, entry.msg_id, entry.item)
+    metrics.count("commands", status="ok")
+    log_event("item_unclaimed", logging.DEBUG, user=payload.user_id, item=entry.item)
 
 @bot.command()
 async def help(ctx):
     help_text = (
         "Commands:\n"
-        '$receipt [mode] [tip(%)] "[notes]" [mentions] - Upload a receipt image and mention users to share with. Mode can be "react" or "share". Add notes to specify how to split the bill. Message sender is included in members list already.\n'
+        '$receipt [mode] [tip(%)] "[notes]" [mentions] - Upload a receipt image and mention users to share with. Mode can be "react", "pick" or "share". "pick" posts all items as select menus in one message instead of one message per item. Add notes to specify how to split the bill. Message sender is included in members list already.\n'
         "$due @user amount - Record that you owe a user a certain amount.\n"
         "$owes @user1 @user2 - Check how much user1 owes user2.\n"
         "$owed - Check how much you owe in total in this server.\n"
+        "$settle - Net out everyone's debts in this server and list the fewest payments that settle them.\n"
         "$alias name - Set an alias for yourself for $receipt share function.\n"
     )
-    await ctx.reply(help_text, mention_author=False)
+    await outbox.reply(ctx, help_text, mention_author=False)
+
+async def process_receipt(ctx, image: discord.Attachment, mode: str, tip: str, notes: str, members: set, item_name: str):
+    # Function to parse and post a single receipt attachment, run by the receipt worker pool
+    if mode == "react" and (not tip or tip[-1] == '%'):
+        # A percentage tip doesn't depend on the subtotal, so items can be posted while they stream in
+        tip_percent = tip_fraction(tip, {})
+        posts = []
+
+        async def post_item(item, price):
+            # Queue the post without waiting for it, so parsing the stream never stalls on rate limits
+            posts.append(asyncio.ensure_future(send_react_message(ctx, item, price * (1 + tip_percent))))
+
+        try:
+            await read_receipt(ctx, image, on_item=post_item)
+        finally:
+            results = await asyncio.gather(*posts, return_exceptions=True)
+            await item_index.record([entry for entry in results if isinstance(entry, ItemMessage)])
+        failures = [result for result in results if isinstance(result, Exception)]
+        if failures:
+            raise failures[0]
+    elif mode in ("react", "pick"):
+        # Parse receipt image
+        pre_tip = await read_receipt(ctx, image)
+        post_tip = pre_tip
+        if tip:
+            tip_percent = tip_fraction(tip, pre_tip)
+            log_event("tip", logging.DEBUG, tip=tip, percent=round(tip_percent, 4))
+            post_tip = {item: price * (1 + tip_percent) for item, price in pre_tip.items()}
+        if mode == "pick":
+            # Post all items as select menus
+            await send_item_picker(post_tip, ctx)
+        else:
+            # Send messages for each item in the receipt
+            await send_react_messages(post_tip, ctx)
+    else:
+        # Parse receipt image
+        pre_tip = await read_receipt(ctx, image)
+        # Send to LLM for processing
+        log_event("share_notes", logging.DEBUG, notes=notes, diners=len(members))
+        per_person = await query_llm(ctx, pre_tip, members, tip, notes)
+        author_id = ctx.message.author.id
+        # Diners were mentioned, so their Member objects are already at hand
+        known = {member.id: member for member in members}
+        resolved = {}
+        for user_id in per_person:
+            member = known.get(int(user_id)) if str(user_id).isdigit() else None
+            resolved[user_id] = member or await directory.find_member(ctx.guild, user_id)
+        ops = []
+        for user_id, amount in per_person.items():
+            user = resolved[user_id]
+            if user and user.id != author_id:
+                ops.append(LedgerOp('add', ctx.guild.id, user.id, author_id, ctx.message.id, item_name, round(amount, 2)))
+        with metrics.span("ledger"):
+            await ledger.apply(ops)
+        per_person_msg = ""
+        err_count = 0
+        for user_id, amount in per_person.items():
+            user_member = resolved[user_id]
+            if user_member:
+                per_person_msg += f"{user_member.mention} owes ${amount:.2f}.\n"
+            else:
+                per_person_msg += f"{user_id} owes ${amount:.2f} (could not match to a user).\n"
+                err_count += 1
+        per_person_msg += "Total: $" + f"{sum(per_person.values()):.2f}."
+        if err_count:
+            log_event("share_unmatched", logging.WARNING, unmatched=err_count)
+        await outbox.reply(ctx, per_person_msg, view=ShareDeleteButton(ctx.message.id, ctx))
+
+async def queue_receipt(ctx, image: discord.Attachment, mode: str, tip: str, notes: str, members: set, item_name: str):
+    # Function to wait for one of the server's slots, then hand the receipt to the worker pool
+    async with guild_semaphores.setdefault(ctx.guild.id, asyncio.Semaphore(RECEIPT_GUILD_CONCURRENCY)):
+        return await receipt_pool.submit(process_receipt, ctx, image, mode, tip, notes, members, item_name)
 
 @bot.command()
 async def receipt(ctx,  mode: str = "react", tip: str = "", notes: str = ""):
     if not ctx.message.attachments:
-        await ctx.reply('Please upload your receipt image.')
-    else:
-        members = set(ctx.message.mentions + [ctx.message.author])
-        images = [a for a in ctx.message.attachments if a.filename.lower().endswith(('.jpg', '.png'))]
-        if not images:
-            await ctx.reply('Please upload a valid image file (.jpg or .png).')
-            return
-        for image in images:
-            if mode == "react":
-                # Parse receipt image
-                pre_tip = await read_receipt(image)
-                post_tip = pre_tip
-                if tip:
-                    if tip[-1] != '%':
-                        tip_percent = float(tip) / sum(float(v) for v in pre_tip.values())
-                    else:
-                        tip_percent = int(tip.strip('%')) / 100
-                    # logging.info(f"Tip percent: {tip_percent}")
-                    post_tip = {item: price * (1 + tip_percent) for item, price in pre_tip.items()}
-                # Send messages for each item in the receipt
-                await send_react_messages(post_tip, ctx)
-            elif mode == "share":
-                if not ctx.message.mentions:
-                    await ctx.reply('Please mention the user(s) you want to share the receipt with.')
-                    return
-                # Parse receipt image
-                pre_tip = await read_receipt(image)
-                # Send to LLM for processing
-                # logging.info("Notes: " + notes)
-                per_person = await query_llm(ctx, pre_tip, members, tip, notes)
-                for user_id, amount in per_person.items():
-                    author_id = ctx.message.author.id
-                    user = await find_user_by_id(ctx.guild, user_id)
-                    if int(user_id) != author_id:
-                        await add_to_ledger(ctx.message.id, "shared receipt", round(amount, 2), ctx.guild, user, ctx.message.author)
-                per_person_msg = ""
-                err_count = 0
-                for user_id, amount in per_person.items():
-                    user_member = await find_user_by_id(ctx.guild, user_id)
-                    if user_member:
-                        per_person_msg += f"{user_member.mention} owes ${amount:.2f}.\n"
-                    else:
-                        per_person_msg += f"{user_id} owes ${amount:.2f} (could not match to a user).\n"
-                        err_count += 1     
-                per_person_msg += "Total: $" + f"{sum(per_person.values()):.2f}."
-                await ctx.reply(per_person_msg, view=ShareDeleteButton(ctx.message.id, ctx))
-            else:
-                await ctx.reply('Invalid mode. Use "react" or "share".')
-                return
+        await outbox.reply(ctx, 'Please upload your receipt image.')
+        return
+    members = set(ctx.message.mentions + [ctx.message.author])
+    images = [a for a in ctx.message.attachments if a.filename.lower().endswith(('.jpg', '.png'))]
+    if not images:
+        await outbox.reply(ctx, 'Please upload a valid image file (.jpg or .png).')
+        return
+    if mode not in ("react", "pick", "share"):
+        await outbox.reply(ctx, 'Invalid mode. Use "react", "pick" or "share".')
+        return
+    if mode == "share" and not ctx.message.mentions:
+        await outbox.reply(ctx, 'Please mention the user(s) you want to share the receipt with.')
+        return
+
+    # All attachments are processed at once and each posts its results when it finishes.
+    # Shares of several photos are one bill, so each photo gets its own ledger item.
+    results = await asyncio.gather(*(
+        queue_receipt(ctx, image, mode, tip, notes, members,
+                      "shared receipt" if len(images) == 1 else f"shared receipt {i + 1}")
+        for i, image in enumerate(images)
+    ), return_exceptions=True)
+    for image, result in zip(images, results):
+        if isinstance(result, asyncio.QueueFull):
+            log_event("receipt_rejected", logging.WARNING, queued=receipt_pool.depth())
+            await outbox.reply(ctx, f"Too many receipts are being processed right now, please send {image.filename} again in a minute.")
+        elif isinstance(result, Exception):
+            logging.error(f"Error processing receipt {image.filename}: {result}")
+            await outbox.reply(ctx, f"There was an error processing {image.filename}. Please try again.")
 
 @bot.command()
 async def due(ctx, member: discord.Member, amount: float):
     if amount > 0:
         # Update ledger with amount owed
-        await add_to_ledger(ctx.message.id, "manual entry", amount, ctx.guild, ctx.message.author, member)
-        await ctx.reply(f'Updated {member.mention}\'s debt by ${amount}.')
+        await ledger.add_item(ctx.guild.id, ctx.message.author.id, member.id, ctx.message.id, "manual entry", amount)
+        await outbox.reply(ctx, f'Updated {member.mention}\'s debt by ${amount}.')
     else:
-        await ctx.reply('Amount must be positive.')
+        await outbox.reply(ctx, 'Amount must be positive.')
 
 @bot.command()
 async def owes(ctx, member1: discord.Member = None, member2: discord.Member = None):
     if member1 and member2:
-        debt_amount = await fetch_user_user_debt(member1, member2, ctx.guild.id)
-        await ctx.reply(f'{member1.mention} owes {member2.mention} ${debt_amount}.')
+        debt_amount = await ledger.pair_debt(ctx.guild.id, member1.id, member2.id)
+        await outbox.reply(ctx, f'{member1.mention} owes {member2.mention} ${debt_amount:.2f}.')
     else:
-        await ctx.reply('Specify two people to see money owed.')
+        await outbox.reply(ctx, 'Specify two people to see money owed.')
 
 @bot.command()
 async def owed(ctx):
-    debt_amount = await fetch_user_debt(ctx.message.author, ctx.guild)
-    await ctx.reply(f'You owe ${debt_amount} in this server.')
+    debt_amount = await ledger.total_debt(ctx.guild.id, ctx.message.author.id)
+    await outbox.reply(ctx, f'You owe ${debt_amount:.2f} in this server.')
+
+@bot.command()
+async def settle(ctx):
+    transfers = settle_debts(net_balances(await ledger.guild_debts(ctx.guild.id)))
+    if not transfers:
+        await outbox.reply(ctx, "Everyone is settled up in this server.", mention_author=False)
+        return
+    lines = [f"<@{payer}> pays <@{payee}> ${cents / 100:.2f}" for payer, payee, cents in transfers]
+    # Keep each reply under Discord's 2000 character limit
+    chunk = f"Settle up with {len(transfers)} payments:"
+    for line in lines:
+        if len(chunk) + len(line) + 1 > 2000:
+            await outbox.reply(ctx, chunk, mention_author=False, allowed_mentions=discord.AllowedMentions.none())
+            chunk = ""
+        chunk += ("\n" if chunk else "") + line
+    await outbox.reply(ctx, chunk, mention_author=False, allowed_mentions=discord.AllowedMentions.none())
 
 @bot.command()
 async def alias(ctx, alias: str):
-    ref = db.reference(f'/aliases/{ctx.guild.id}')
-    new_alias = {ctx.message.author.id: alias}
-    if ref.get():
-        ref.update(new_alias)
+    await directory.set_alias(ctx.guild.id, ctx.message.author.id, alias)
+    await outbox.reply(ctx, f'"{alias}" set as your alias for this server.')
+
+# Admin command to recompute running balances from raw ledger items
+@bot.command()
+@commands.has_permissions(manage_guild=True)
+async def rebuild_balances(ctx, mode: str = "rebuild"):
+    verify_only = mode == "verify"
+    mismatches = await ledger.rebuild_balances(ctx.guild.id, verify_only=verify_only)
+    if not mismatches:
+        await outbox.reply(ctx, "Balances are in sync with the ledger.", mention_author=False)
+    elif verify_only:
+        await outbox.reply(ctx, f"{len(mismatches)} balances are out of sync. Run `$rebuild_balances` to fix them.", mention_author=False)
     else:
-        ref.set(new_alias)
-    await ctx.reply(f'"{alias}" set as your alias for this server.')
+        await outbox.reply(ctx, f"Rebuilt balances, {len(mismatches)} were out of sync.", mention_author=False)
+
+# Admin command to index bills created before the bill index existed
+@bot.command()
+@commands.has_permissions(manage_guild=True)
+async def backfill_bills(ctx):
+    count = await ledger.backfill_bill_index(ctx.guild.id)
+    await outbox.reply(ctx, f"Indexed {count} bills.", mention_author=False)
+
+# Debug command to view receipt cache counters
+@bot.command()
+async def cache_stats(ctx):
+    stats = receipt_cache.stats
+    await outbox.reply(
+        ctx,
+        f"Receipt cache: {stats['memory_hits']} memory hits, {stats['disk_hits']} disk hits, {stats['misses']} misses.",
+        mention_author=False,
+    )
+
+# Admin command to view recent stage timings and call counts for this server
+@bot.command()
+@commands.has_permissions(manage_guild=True)
+async def stats(ctx):
+    rows = metrics.percentiles(ctx.guild.id)
+    if not rows:
+        await outbox.reply(ctx, "No timings recorded in this server yet.", mention_author=False)
+        return
+    lines = [f"{'command':<16} {'stage':<12} {'n':>5} {'p50':>8} {'p95':>8} {'p99':>8}"]
+    for command, stage, n, p50, p95, p99 in rows:
+        lines.append(f"{command:<16} {stage:<12} {n:>5} {p50 * 1000:>6.0f}ms {p95 * 1000:>6.0f}ms {p99 * 1000:>6.0f}ms")
+    totals = metrics.totals(ctx.guild.id)
+    summary = (
+        f"LLM calls: {totals['llm_calls']:.0f}, tokens: {totals['llm_tokens']:.0f}, "
+        f"critic rejections: {totals['critic_rejections']:.0f}, "
+        f"DB round trips: {totals['db_round_trips']:.0f}, REST requests: {totals['rest_requests']:.0f}, "
+        f"replies queued in this channel: {outbox.depth(ctx.channel.id)}"
+    )
+    # Keep the reply under Discord's 2000 character limit
+    while len(lines) > 1 and sum(len(line) + 1 for line in lines) + len(summary) > 1900:
+        lines.pop()
+    table = "\n".join(lines)
+    await outbox.reply(ctx, f"```\n{table}\n```{summary}", mention_author=False)
 
 # Debug command to view all aliases
 @bot.command()
 async def debug_aliases(ctx, name: str):
-    ref = db.reference('/aliases')
-    snapshot = ref.get()
-    if snapshot:
-        # logging.info(f"Alias snapshot: {snapshot}")  # Log the snapshot for debugging
-        for user_id, data in snapshot.items():
-            if data.get('alias', '').lower() == name.lower():
-                # logging.info(f"Found alias: {user_id} for {name}")  # Log the found alias
-                await ctx.reply(f"Alias for {name}: {user_id}")
+    aliases = await ledger.get_aliases(ctx.guild.id)
+    if aliases:
+        log_event("aliases_loaded", logging.DEBUG, aliases=aliases)
+        for alias, user_id in aliases.items():
+            if alias.lower() == name.lower():
+                log_event("alias_found", logging.DEBUG, alias=name, user=user_id)
+                await outbox.reply(ctx, f"Alias for {name}: {user_id}")
     else:
-        await ctx.reply("No aliases found in the database.")
+        await outbox.reply(ctx, "No aliases found in the database.")
 
-bot.run(os.environ.get("DISCORD_TOKEN"))
+if __name__ == "__main__":
+    bot.run(os.environ.get("DISCORD_TOKEN"))
@@ -0,0 +1,142 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import re
+import time
+
+from telemetry import log_event, metrics
+
+# Lower runs first: replies to a command before bulk posts like react-mode items
+INTERACTIVE = 0
+BULK = 1
+
+# Discord's message length limit, merged replies must fit in one message
+MAX_MESSAGE_LENGTH = 2000
+
+# Keyword arguments that make a message more than text, so it can't be merged with its neighbours
+UNMERGEABLE_KWARGS = ("view", "embed", "embeds", "file", "files", "stickers", "delete_after")
+
+CHANNEL_MESSAGES_ROUTE = re.compile(r"/channels/(\d+)/messages$")
+
+
+class _Outgoing:
+    __slots__ = ("ctx", "content", "kwargs", "mergeable", "futures", "context")
+
+    def __init__(self, ctx, content: str, kwargs: dict, mergeable: bool):
+        self.ctx = ctx
+        self.content = content
+        self.kwargs = kwargs
+        self.mergeable = mergeable
+        self.futures = [asyncio.get_running_loop().create_future()]
+        # Sent under the caller's context so REST metrics stay attributed to its guild and command
+        self.context = contextvars.copy_context()
+
+    def merges_with(self, other: "_Outgoing") -> bool:
+        return (
+            self.mergeable and other.mergeable
+            and self.ctx.message.id == other.ctx.message.id
+            and self.kwargs == other.kwargs
+            and len(self.content) + 1 + len(other.content) <= MAX_MESSAGE_LENGTH
+        )
+
+
+class SendQueue:
+    """Per-channel scheduler for every message the bot posts.
+
+    Each channel has one worker that sends its queued replies in priority
+    order. Adjacent plain-text replies to the same command are merged into one
+    message, and the worker waits out an exhausted rate-limit bucket itself
+    (tracked from the response headers) so handler tasks never sleep inside
+    discord.py. Callers get a future for the sent message.
+    """
+
+    def __init__(self):
+        # channel ID -> heap of (priority, sequence, _Outgoing)
+        self._queues = {}
+        self._workers = {}
+        # channel ID -> (requests remaining, monotonic time the bucket resets)
+        self._buckets = {}
+        self._sequence = itertools.count()
+
+    def reply(self, ctx, content: str, priority: int = INTERACTIVE, mergeable: bool | None = None, **kwargs) -> asyncio.Future:
+        # Queue ctx.reply(content, **kwargs), the future resolves to the sent message
+        if mergeable is None:
+            mergeable = not any(kwargs.get(name) for name in UNMERGEABLE_KWARGS)
+        outgoing = _Outgoing(ctx, content, kwargs, mergeable)
+        channel_id = ctx.channel.id
+        heapq.heappush(self._queues.setdefault(channel_id, []), (priority, next(self._sequence), outgoing))
+        if channel_id not in self._workers:
+            self._workers[channel_id] = asyncio.create_task(self._drain(channel_id))
+        self._report_depth()
+        return outgoing.futures[0]
+
+    def depth(self, channel_id: int | None = None) -> int:
+        if channel_id is not None:
+            return len(self._queues.get(channel_id, ()))
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _report_depth(self):
+        metrics.gauge("send_queue_depth", self.depth())
+        metrics.gauge("send_queue_channels", len(self._queues))
+
+    def observe_response(self, method: str, path: str, status: int, headers):
+        # Fed from the REST trace, remembers each channel's message bucket
+        match = CHANNEL_MESSAGES_ROUTE.search(path)
+        if method != "POST" or match is None:
+            return
+        channel_id = int(match.group(1))
+        if status == 429:
+            retry_after = float(headers.get("Retry-After", 1))
+            self._buckets[channel_id] = (0, time.monotonic() + retry_after)
+            metrics.count("send_rate_limited")
+            return
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset_after = headers.get("X-RateLimit-Reset-After")
+        if remaining is not None and reset_after is not None:
+            self._buckets[channel_id] = (int(remaining), time.monotonic() + float(reset_after))
+
+    async def _wait_for_bucket(self, channel_id: int):
+        remaining, reset_at = self._buckets.get(channel_id, (1, 0.0))
+        delay = reset_at - time.monotonic()
+        if remaining <= 0 and delay > 0:
+            metrics.count("send_waits")
+            log_event("send_wait", logging.DEBUG, channel=channel_id, ms=round(delay * 1000), queued=self.depth(channel_id))
+            await asyncio.sleep(delay)
+
+    def _next_batch(self, queue: list) -> _Outgoing:
+        # Pop the next message and fold in whatever queued right behind it can share the send
+        _, _, outgoing = heapq.heappop(queue)
+        while queue and outgoing.merges_with(queue[0][2]):
+            _, _, following = heapq.heappop(queue)
+            outgoing.content += "\n" + following.content
+            outgoing.futures += following.futures
+            metrics.count("send_merged")
+        return outgoing
+
+    async def _drain(self, channel_id: int):
+        queue = self._queues[channel_id]
+        try:
+            while queue:
+                # Waiting here lets more replies queue up and merge
+                await self._wait_for_bucket(channel_id)
+                outgoing = self._next_batch(queue)
+                self._report_depth()
+                try:
+                    message = await asyncio.create_task(
+                        outgoing.ctx.reply(outgoing.content, **outgoing.kwargs), context=outgoing.context,
+                    )
+                except Exception as e:
+                    logging.error(f"Sending to channel {channel_id} failed: {e}")
+                    for future in outgoing.futures:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for future in outgoing.futures:
+                    if not future.done():
+                        future.set_result(message)
+        finally:
+            del self._queues[channel_id]
+            del self._workers[channel_id]
+            self._report_depth()
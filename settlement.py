@@ -0,0 +1,54 @@
+import heapq
+from collections import defaultdict
+
+
+def net_balances(debts) -> dict:
+    """Collapse (debtor, creditor, cents) debts into one net figure per user.
+
+    Positive means the user is owed money, negative means they owe. Mutual and
+    cyclic debts cancel out here.
+    """
+    net = defaultdict(int)
+    # Self-debts and zero amounts cancel out on their own, so the hot loop has no branches
+    for debtor, creditor, cents in debts:
+        net[debtor] -= cents
+        net[creditor] += cents
+    return {user: cents for user, cents in net.items() if cents}
+
+
+def settle(net: dict) -> list[tuple]:
+    """Turn net balances into a near-minimal list of (payer, payee, cents) transfers.
+
+    Debtors and creditors with exactly matching amounts are paired first, since
+    each such pair settles two people with one transfer. The rest is settled
+    greedily largest-first, which needs at most one transfer fewer than the
+    number of people left.
+    """
+    debtors = defaultdict(list)
+    for user, cents in net.items():
+        if cents < 0:
+            debtors[-cents].append(user)
+
+    transfers = []
+    creditors = []
+    for user, cents in sorted(net.items(), key=lambda kv: (-kv[1], str(kv[0]))):
+        if cents <= 0:
+            continue
+        if debtors.get(cents):
+            transfers.append((debtors[cents].pop(), user, cents))
+        else:
+            creditors.append((-cents, str(user), user))
+
+    payers = [(-cents, str(user), user) for cents, users in debtors.items() for user in users]
+    heapq.heapify(payers)
+    heapq.heapify(creditors)
+    while payers and creditors:
+        owed, payer_key, payer = heapq.heappop(payers)
+        due, payee_key, payee = heapq.heappop(creditors)
+        amount = min(-owed, -due)
+        transfers.append((payer, payee, amount))
+        if -owed > amount:
+            heapq.heappush(payers, (owed + amount, payer_key, payer))
+        if -due > amount:
+            heapq.heappush(creditors, (due + amount, payee_key, payee))
+    return transfers
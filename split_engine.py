@@ -0,0 +1,235 @@
+import os
+import re
+from decimal import Decimal, ROUND_FLOOR, ROUND_HALF_UP
+
+# Bounds for the actor/critic fallback in query_llm
+MAX_LLM_ROUNDS = int(os.environ.get("SPLIT_MAX_LLM_ROUNDS", "3"))
+LLM_DEADLINE_SECONDS = float(os.environ.get("SPLIT_LLM_DEADLINE_SECONDS", "90"))
+
+HAD_VERBS = r"(?:had|ate|got|ordered|drank)"
+SENTENCE_SPLIT = re.compile(r"[.;\n]+")
+CLAUSE_SPLIT = re.compile(rf",?\s+and\s+(?=\S+\s+{HAD_VERBS}\b)|,\s*(?=\S+\s+{HAD_VERBS}\b)", re.IGNORECASE)
+LIST_SPLIT = re.compile(r"\s*(?:,|&|\band\b)\s*", re.IGNORECASE)
+HAD_CLAUSE = re.compile(rf"^(?P<who>.+?)\s+{HAD_VERBS}\s+(?P<what>.+)$", re.IGNORECASE)
+EXCLUDE_CLAUSES = [
+    re.compile(r"^(?:exclude|excluding|without|not|except)\s+(?P<who>.+)$", re.IGNORECASE),
+    re.compile(r"^(?P<who>.+?)\s+(?:didn't|did not|doesn't|does not)\s+(?:eat|pay|join|come|share)\b.*$", re.IGNORECASE),
+    re.compile(r"^(?P<who>.+?)\s+(?:is|was|are|were)\s+(?:excluded|not included|not sharing)$", re.IGNORECASE),
+]
+EVEN_CLAUSE = re.compile(r"^(?:split\s+)?(?:evenly|equally|even|everything\s+(?:was\s+)?shared)(?:\s+split)?$", re.IGNORECASE)
+MENTION = re.compile(r"^<@!?(\d+)>$")
+ARTICLES = re.compile(r"^(?:the|some|their|his|her|my)\s+", re.IGNORECASE)
+# "a burger" means one of them, never every numbered instance on the receipt
+SINGULAR = re.compile(r"^(?:a|an|one)\s+", re.IGNORECASE)
+NUMBER_SUFFIX = re.compile(r"\s*\d+$")
+
+
+def to_cents(amount) -> int:
+    return int(Decimal(str(amount)).scaleb(2).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def tip_fraction(tip: str, pre_tip: dict) -> float:
+    # Tip is either a percentage ("18%") or an absolute amount spread over the subtotal
+    if not tip:
+        return 0.0
+    if tip[-1] == '%':
+        return float(tip.strip('%')) / 100
+    subtotal = sum(float(v) for v in pre_tip.values())
+    return float(tip) / subtotal if subtotal else 0.0
+
+
+def distribute_cents(total_cents: int, weights: dict, offset: int = 0) -> dict:
+    """Split total_cents over weights so the parts sum exactly to the total.
+
+    Leftover cents go to the largest remainders; ties are broken starting at
+    position `offset` so repeated splits don't always favour the same person.
+    """
+    keys = list(weights)
+    weight_sum = sum(weights.values())
+    if not keys or weight_sum <= 0:
+        return {}
+    shares = {}
+    remainders = []
+    for i, key in enumerate(keys):
+        exact = Decimal(total_cents) * Decimal(weights[key]) / Decimal(weight_sum)
+        # Rounded down, not toward zero, so negative amounts (discounts) also leave a non-negative remainder
+        shares[key] = int(exact.to_integral_value(rounding=ROUND_FLOOR))
+        remainders.append((exact - shares[key], -((i - offset) % len(keys)), key))
+    leftover = total_cents - sum(shares.values())
+    for _, _, key in sorted(remainders, reverse=True)[:leftover]:
+        shares[key] += 1
+    return shares
+
+
+def apply_tip(per_person: dict, tip_percent: float) -> dict:
+    # Scale each person's share by the tip while keeping the grand total exact to the cent
+    cents = {user: to_cents(amount) for user, amount in per_person.items()}
+    total = round(sum(cents.values()) * (1 + tip_percent))
+    if not any(cents.values()):
+        return {user: 0.0 for user in cents}
+    return {user: c / 100 for user, c in distribute_cents(total, cents).items()}
+
+
+def reconcile_total(amounts: dict, total: float) -> dict | None:
+    """Adjust amounts so they add up to total exactly, or return None if they are off by more than rounding.
+
+    A gap of up to one cent per amount is rounding from spreading tax and fees
+    over lines, and is closed a cent at a time starting with the largest amounts.
+    """
+    cents = {key: to_cents(amount) for key, amount in amounts.items()}
+    gap = to_cents(total) - sum(cents.values())
+    if abs(gap) > len(cents):
+        return None
+    step = 1 if gap > 0 else -1
+    for key in sorted(cents, key=cents.get, reverse=True)[:abs(gap)]:
+        cents[key] += step
+    return {key: c / 100 for key, c in cents.items()}
+
+
+def add_unique(items: dict, name: str, price: float) -> str:
+    # Add an item under a name not used yet, numbering repeats the way the receipt prompt asks for
+    name = name.strip() or "Item"
+    key, n = name, 2
+    while key in items:
+        key = f"{name} {n}"
+        n += 1
+    items[key] = price
+    return key
+
+
+def _normalize(name: str) -> str:
+    name = ARTICLES.sub("", name.strip().strip("\"'").lower())
+    return re.sub(r"\s+", " ", name)
+
+
+def _resolve_user(name: str, diners: list[int], aliases_dict: dict):
+    name = name.strip()
+    mention = MENTION.match(name)
+    if mention:
+        return int(mention.group(1))
+    if name.isdigit() and int(name) in diners:
+        return int(name)
+    lowered = {alias.lower(): user_id for alias, user_id in aliases_dict.items()}
+    if name.lower() in lowered:
+        return int(lowered[name.lower()])
+    return None
+
+
+def _resolve_item(phrase: str, items: list[str]):
+    phrase = _normalize(phrase)
+    singular = SINGULAR.match(phrase) is not None
+    phrase = SINGULAR.sub("", phrase)
+    if not phrase:
+        return None
+    plural = phrase.endswith("s") and not singular
+    candidates = [phrase, phrase[:-1]] if plural else [phrase]
+    for candidate in candidates:
+        # Every instance of the item, numbered or not ("Burger", "Burger 2"), so "the burgers" gets them all.
+        # "a burger" or "the burger" can't say which one was meant, so the LLM has to work it out
+        instances = [item for item in items if NUMBER_SUFFIX.sub("", _normalize(item)) == candidate]
+        if len(instances) > 1:
+            return instances if plural else None
+        exact = [item for item in items if _normalize(item) == candidate]
+        if len(exact) == 1:
+            return exact
+        if instances:
+            return instances
+    # Otherwise the phrase has to be whole words of exactly one item, "fries" for "French Fries"
+    # but never "tea" for "Steak"
+    for candidate in candidates:
+        words = re.compile(rf"\b{re.escape(candidate)}\b")
+        partial = [item for item in items if words.search(_normalize(item))]
+        if len(partial) == 1:
+            return partial
+    return None
+
+
+def _resolve_users(names: str, diners: list[int], aliases_dict: dict):
+    users = []
+    for name in LIST_SPLIT.split(names):
+        if not name:
+            continue
+        user_id = _resolve_user(name, diners, aliases_dict)
+        if user_id is None:
+            return None
+        users.append(user_id)
+    return users or None
+
+
+def _clauses(sentence: str) -> list[str]:
+    # Split "A had x and B had y" into clauses without breaking up "A and B had x"
+    clauses = []
+    pending = ""
+    for piece in CLAUSE_SPLIT.split(sentence.strip()):
+        piece = f"{pending} and {piece}" if pending else piece
+        if re.search(rf"\b{HAD_VERBS}\b", piece, re.IGNORECASE) or any(p.match(piece) for p in EXCLUDE_CLAUSES):
+            clauses.append(piece)
+            pending = ""
+        else:
+            pending = piece
+    if pending:
+        clauses.append(pending)
+    return clauses
+
+
+def parse_notes(notes: str, items: list[str], diners: list[int], aliases_dict: dict):
+    """Parse simple split notes into (item -> eaters, excluded users).
+
+    Returns None when any part of the notes is not understood so the caller can
+    fall back to the LLM.
+    """
+    assignments = {}
+    excluded = set()
+    for sentence in SENTENCE_SPLIT.split(notes or ""):
+        for clause in _clauses(sentence):
+            clause = clause.strip(" ,")
+            if not clause or EVEN_CLAUSE.match(clause):
+                continue
+            had = HAD_CLAUSE.match(clause)
+            if had:
+                users = _resolve_users(had.group("who"), diners, aliases_dict)
+                if users is None:
+                    return None
+                # Try the whole phrase first so "fish and chips" can still be a single item
+                whole = _resolve_item(had.group("what"), items)
+                phrases = [had.group("what")] if whole else [p for p in LIST_SPLIT.split(had.group("what")) if p]
+                for phrase in phrases:
+                    matched = _resolve_item(phrase, items)
+                    if matched is None:
+                        return None
+                    for item in matched:
+                        eaters = assignments.setdefault(item, [])
+                        eaters.extend(u for u in users if u not in eaters)
+                continue
+            for pattern in EXCLUDE_CLAUSES:
+                exclude = pattern.match(clause)
+                if exclude:
+                    users = _resolve_users(exclude.group("who"), diners, aliases_dict)
+                    if users is None:
+                        return None
+                    excluded.update(users)
+                    break
+            else:
+                return None
+    return assignments, excluded
+
+
+def split_bill(pre_tip: dict, notes: str, diners: list[int], aliases_dict: dict, tip: str):
+    """Split a parsed receipt locally, or return None if the notes need the LLM."""
+    parsed = parse_notes(notes, list(pre_tip), diners, aliases_dict or {})
+    if parsed is None:
+        return None
+    assignments, excluded = parsed
+    sharers = [d for d in diners if d not in excluded]
+    if not sharers and len(assignments) < len(pre_tip):
+        return None
+
+    owed = {user: 0 for user in sharers}
+    for eaters in assignments.values():
+        owed.update({user: 0 for user in eaters if user not in owed})
+    for i, (item, price) in enumerate(pre_tip.items()):
+        eaters = assignments.get(item) or sharers
+        for user, cents in distribute_cents(to_cents(price), {u: 1 for u in eaters}, offset=i).items():
+            owed[user] += cents
+
+    return apply_tip({user: cents / 100 for user, cents in owed.items()}, tip_fraction(tip, pre_tip))
@@ -0,0 +1,308 @@
+import asyncio
+import functools
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from item_index import ItemMessage
+from ledger import LedgerOp, LedgerStore
+from split_engine import to_cents
+from telemetry import metrics
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    guild_id INTEGER NOT NULL,
+    debtor_id INTEGER NOT NULL,
+    creditor_id INTEGER NOT NULL,
+    msg_id INTEGER NOT NULL,
+    item TEXT NOT NULL,
+    price REAL NOT NULL,
+    cents INTEGER NOT NULL,
+    PRIMARY KEY (guild_id, debtor_id, creditor_id, msg_id, item)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS items_by_bill ON items (guild_id, msg_id);
+
+CREATE TABLE IF NOT EXISTS balances (
+    guild_id INTEGER NOT NULL,
+    debtor_id INTEGER NOT NULL,
+    creditor_id INTEGER NOT NULL,
+    cents INTEGER NOT NULL,
+    PRIMARY KEY (guild_id, debtor_id, creditor_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS aliases (
+    guild_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    alias TEXT NOT NULL,
+    PRIMARY KEY (guild_id, user_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS item_messages (
+    guild_id INTEGER NOT NULL,
+    msg_id INTEGER NOT NULL,
+    item TEXT NOT NULL,
+    price REAL NOT NULL,
+    creditor_id INTEGER NOT NULL,
+    PRIMARY KEY (guild_id, msg_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS guild_versions (
+    guild_id INTEGER PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS processed_events (
+    event_key TEXT PRIMARY KEY,
+    handled_at REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+# Expired event keys are swept after this many claims
+EVENT_PRUNE_INTERVAL = 1000
+
+
+class SQLiteLedger(LedgerStore):
+    """Debt ledger in a local SQLite file.
+
+    Items, running balances and the bill index all live in one database, so
+    every batch updates items and balances in a single transaction. Balance
+    queries are primary-key lookups and bill deletion uses the items_by_bill
+    index. Every write bumps guild_versions for the guilds it touched, in the
+    same transaction, for read caches. The connection is used from one worker
+    thread in WAL mode.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-ledger")
+        # Several bot processes can share the file, so wait on their write locks instead of failing
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._claims = 0
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+
+    async def _run(self, fn, *args):
+        metrics.count("db_round_trips", backend="sqlite")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args))
+
+    def _transaction(self, fn, *args):
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(*args)
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+        return result
+
+    def _touch(self, guild_id: int):
+        self._conn.execute(
+            "INSERT INTO guild_versions (guild_id, version) VALUES (?, 1)"
+            " ON CONFLICT (guild_id) DO UPDATE SET version = version + 1",
+            (guild_id,),
+        )
+
+    async def change_token(self, guild_id: int):
+        rows = await self._run(self._query, "SELECT version FROM guild_versions WHERE guild_id = ?", guild_id)
+        return rows[0][0] if rows else None
+
+    def _adjust_balance(self, guild_id: int, debtor_id: int, creditor_id: int, cents: int):
+        if not cents:
+            return
+        self._conn.execute(
+            "INSERT INTO balances (guild_id, debtor_id, creditor_id, cents) VALUES (?, ?, ?, ?)"
+            " ON CONFLICT (guild_id, debtor_id, creditor_id) DO UPDATE SET cents = cents + excluded.cents",
+            (guild_id, debtor_id, creditor_id, cents),
+        )
+        self._conn.execute(
+            "DELETE FROM balances WHERE guild_id = ? AND debtor_id = ? AND creditor_id = ? AND cents = 0",
+            (guild_id, debtor_id, creditor_id),
+        )
+
+    def _apply_ops(self, ops: list[LedgerOp]) -> list:
+        results = []
+        for op in ops:
+            key = (op.guild_id, op.debtor_id, op.creditor_id, op.msg_id, op.item)
+            row = self._conn.execute(
+                "SELECT price, cents FROM items WHERE guild_id = ? AND debtor_id = ? AND creditor_id = ?"
+                " AND msg_id = ? AND item = ?",
+                key,
+            ).fetchone()
+            if op.kind == 'add':
+                cents = to_cents(op.price)
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO items (guild_id, debtor_id, creditor_id, msg_id, item, price, cents)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (*key, op.price, cents),
+                )
+                self._adjust_balance(op.guild_id, op.debtor_id, op.creditor_id, cents - (row[1] if row else 0))
+                results.append(None)
+            elif row is None:
+                results.append(None)
+            else:
+                self._conn.execute(
+                    "DELETE FROM items WHERE guild_id = ? AND debtor_id = ? AND creditor_id = ?"
+                    " AND msg_id = ? AND item = ?",
+                    key,
+                )
+                self._adjust_balance(op.guild_id, op.debtor_id, op.creditor_id, -row[1])
+                results.append({'item': op.item, 'price': row[0]})
+        for guild_id in {op.guild_id for op in ops}:
+            self._touch(guild_id)
+        return results
+
+    async def _write_batch(self, ops: list[LedgerOp]) -> list:
+        return await self._run(self._transaction, self._apply_ops, ops)
+
+    def _remove_bill(self, guild_id: int, msg_id: int):
+        rows = self._conn.execute(
+            "SELECT debtor_id, creditor_id, SUM(cents) FROM items WHERE guild_id = ? AND msg_id = ?"
+            " GROUP BY debtor_id, creditor_id",
+            (guild_id, msg_id),
+        ).fetchall()
+        self._conn.execute("DELETE FROM items WHERE guild_id = ? AND msg_id = ?", (guild_id, msg_id))
+        for debtor_id, creditor_id, cents in rows:
+            self._adjust_balance(guild_id, debtor_id, creditor_id, -cents)
+        self._touch(guild_id)
+
+    async def remove_bill(self, guild_id: int, msg_id: int):
+        await self._run(self._transaction, self._remove_bill, guild_id, msg_id)
+
+    def _query(self, sql: str, *params):
+        return self._conn.execute(sql, params).fetchall()
+
+    async def bill_items(self, guild_id: int, msg_id: int) -> list[LedgerOp]:
+        rows = await self._run(
+            self._query,
+            "SELECT guild_id, debtor_id, creditor_id, msg_id, item, price FROM items WHERE guild_id = ? AND msg_id = ?",
+            guild_id, msg_id,
+        )
+        return [LedgerOp('add', *row) for row in rows]
+
+    async def pair_debt(self, guild_id: int, debtor_id: int, creditor_id: int) -> float:
+        rows = await self._run(
+            self._query,
+            "SELECT cents FROM balances WHERE guild_id = ? AND debtor_id = ? AND creditor_id = ?",
+            guild_id, debtor_id, creditor_id,
+        )
+        return (rows[0][0] if rows else 0) / 100
+
+    async def total_debt(self, guild_id: int, debtor_id: int) -> float:
+        rows = await self._run(
+            self._query,
+            "SELECT COALESCE(SUM(cents), 0) FROM balances WHERE guild_id = ? AND debtor_id = ?",
+            guild_id, debtor_id,
+        )
+        return rows[0][0] / 100
+
+    async def guild_debts(self, guild_id: int) -> list[tuple]:
+        rows = await self._run(
+            self._query, "SELECT debtor_id, creditor_id, cents FROM balances WHERE guild_id = ?", guild_id,
+        )
+        return [tuple(row) for row in rows]
+
+    def _rebuild_balances(self, guild_id: int, verify_only: bool) -> list[tuple]:
+        actual = {
+            (debtor_id, creditor_id): cents
+            for debtor_id, creditor_id, cents in self._conn.execute(
+                "SELECT debtor_id, creditor_id, SUM(cents) FROM items WHERE guild_id = ?"
+                " GROUP BY debtor_id, creditor_id HAVING SUM(cents) != 0",
+                (guild_id,),
+            )
+        }
+        stored = {
+            (debtor_id, creditor_id): cents
+            for debtor_id, creditor_id, cents in self._conn.execute(
+                "SELECT debtor_id, creditor_id, cents FROM balances WHERE guild_id = ?", (guild_id,),
+            )
+        }
+        mismatches = [
+            (*pair, stored.get(pair, 0), actual.get(pair, 0))
+            for pair in set(actual) | set(stored)
+            if stored.get(pair, 0) != actual.get(pair, 0)
+        ]
+        if mismatches and not verify_only:
+            self._conn.execute("DELETE FROM balances WHERE guild_id = ?", (guild_id,))
+            self._conn.executemany(
+                "INSERT INTO balances (guild_id, debtor_id, creditor_id, cents) VALUES (?, ?, ?, ?)",
+                [(guild_id, *pair, cents) for pair, cents in actual.items()],
+            )
+            self._touch(guild_id)
+        return mismatches
+
+    async def rebuild_balances(self, guild_id: int, verify_only: bool = False) -> list[tuple]:
+        return await self._run(self._transaction, self._rebuild_balances, guild_id, verify_only)
+
+    async def get_aliases(self, guild_id: int) -> dict:
+        rows = await self._run(self._query, "SELECT alias, user_id FROM aliases WHERE guild_id = ?", guild_id)
+        return dict(rows)
+
+    async def all_aliases(self) -> dict:
+        aliases = {}
+        for guild_id, alias, user_id in await self._run(self._query, "SELECT guild_id, alias, user_id FROM aliases"):
+            aliases.setdefault(guild_id, {})[alias] = user_id
+        return aliases
+
+    def _set_alias(self, guild_id: int, user_id: int, alias: str):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO aliases (guild_id, user_id, alias) VALUES (?, ?, ?)", (guild_id, user_id, alias),
+        )
+        self._touch(guild_id)
+
+    async def set_alias(self, guild_id: int, user_id: int, alias: str):
+        await self._run(self._transaction, self._set_alias, guild_id, user_id, alias)
+
+    def _record_item_messages(self, entries: list[ItemMessage]):
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO item_messages (guild_id, msg_id, item, price, creditor_id) VALUES (?, ?, ?, ?, ?)",
+            entries,
+        )
+
+    async def record_item_messages(self, entries: list[ItemMessage]):
+        if entries:
+            await self._run(self._transaction, self._record_item_messages, entries)
+
+    async def lookup_item_message(self, guild_id: int, msg_id: int) -> ItemMessage | None:
+        rows = await self._run(
+            self._query,
+            "SELECT guild_id, msg_id, item, price, creditor_id FROM item_messages WHERE guild_id = ? AND msg_id = ?",
+            guild_id, msg_id,
+        )
+        return ItemMessage(*rows[0]) if rows else None
+
+    def _claim_event(self, key: str, ttl: float) -> bool:
+        cutoff = time.time() - ttl
+        self._claims += 1
+        if self._claims % EVENT_PRUNE_INTERVAL == 0:
+            self._conn.execute("DELETE FROM processed_events WHERE handled_at < ?", (cutoff,))
+        else:
+            self._conn.execute("DELETE FROM processed_events WHERE event_key = ? AND handled_at < ?", (key, cutoff))
+        cursor = self._conn.execute(
+            "INSERT OR IGNORE INTO processed_events (event_key, handled_at) VALUES (?, ?)", (key, time.time()),
+        )
+        return cursor.rowcount == 1
+
+    async def claim_event(self, key: str, ttl: float) -> bool:
+        return await self._run(self._transaction, self._claim_event, key, ttl)
+
+    def _export(self):
+        items = [
+            LedgerOp('add', *row)
+            for row in self._conn.execute("SELECT guild_id, debtor_id, creditor_id, msg_id, item, price FROM items")
+        ]
+        aliases = [tuple(row) for row in self._conn.execute("SELECT guild_id, user_id, alias FROM aliases")]
+        item_messages = [
+            ItemMessage(*row)
+            for row in self._conn.execute("SELECT guild_id, msg_id, item, price, creditor_id FROM item_messages")
+        ]
+        return items, aliases, item_messages
+
+    async def export(self):
+        return await self._run(self._export)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._conn.close()
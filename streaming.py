@@ -0,0 +1,66 @@
+import json
+
+
+class JsonArrayStream:
+    """Incrementally parses streamed LLM text and yields the objects of one top-level array.
+
+    For output like {"items": [{...}, {...}], "total": 1.0} with key "items",
+    each object in the array is emitted as soon as its closing "}" has
+    arrived. Malformed objects are skipped and left to the full parse.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self._buffer = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._last_string = None
+        self._last_key = None
+        self._in_array = False
+        self._element_start = None
+        self.done = False
+
+    def feed(self, text: str) -> list:
+        self._buffer += text
+        elements = []
+        while self._pos < len(self._buffer) and not self.done:
+            ch = self._buffer[self._pos]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    self._last_string = self._buffer[self._string_start + 1:self._pos]
+            elif self._depth == 0:
+                if ch == '{':
+                    self._depth = 1
+            elif ch == '"':
+                self._in_string = True
+                self._string_start = self._pos
+            elif ch == ':' and self._depth == 1:
+                self._last_key = self._last_string
+            elif ch in '{[':
+                if self._depth == 1 and ch == '[' and self._last_key == self.key:
+                    self._in_array = True
+                elif self._in_array and self._depth == 2 and ch == '{':
+                    self._element_start = self._pos
+                self._depth += 1
+            elif ch in '}]':
+                self._depth -= 1
+                if self._in_array and self._depth == 2 and self._element_start is not None:
+                    try:
+                        elements.append(json.loads(self._buffer[self._element_start:self._pos + 1]))
+                    except json.JSONDecodeError:
+                        pass
+                    self._element_start = None
+                elif self._in_array and self._depth == 1:
+                    self._in_array = False
+                if self._depth == 0:
+                    self.done = True
+            self._pos += 1
+        return elements
@@ -0,0 +1,233 @@
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+# Local metrics endpoint, disabled unless a port is set
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+# Timings kept per guild, command and stage for $stats percentiles
+METRICS_RECENT_SAMPLES = int(os.environ.get("METRICS_RECENT_SAMPLES", "500"))
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+PREFIX = "receipt_bot"
+DESCRIPTIONS = {
+    "stage_seconds": "Time spent in each stage of a command or event.",
+    "commands": "Commands and events handled.",
+    "llm_calls": "GenAI requests made.",
+    "llm_tokens": "GenAI tokens used, by prompt or output.",
+    "critic_rejections": "Splits the critic rejected.",
+    "receipt_repairs": "Repair prompts sent for receipt parses, by reason.",
+    "receipt_unreconciled": "Receipts whose items still didn't add up to the printed total after repairs.",
+    "split_repairs": "Splits sent back to the actor without a critic call, by reason.",
+    "db_round_trips": "Database calls made.",
+    "rest_requests": "Discord REST requests made, by method and status.",
+    "send_merged": "Replies merged into the message queued ahead of them.",
+    "send_waits": "Times a channel's send queue waited for its rate-limit bucket to reset.",
+    "send_rate_limited": "Message sends Discord answered with 429.",
+    "send_queue_depth": "Messages waiting in the outbound send queue.",
+    "send_queue_channels": "Channels with messages waiting to be sent.",
+    "receipt_queue_depth": "Receipts waiting for a worker.",
+    "duplicate_events": "Gateway events dropped because they were already handled.",
+}
+
+# (guild ID, command) the current task is working for, and the innermost open span
+_scope = contextvars.ContextVar("telemetry_scope", default=("", ""))
+_stage = contextvars.ContextVar("telemetry_stage", default="")
+
+events = logging.getLogger("receipt_bot.events")
+
+
+def bind(guild_id, command: str):
+    # Attribute everything recorded from this task (and tasks it starts) to a guild and command
+    _scope.set(("" if guild_id is None else str(guild_id), command))
+
+
+def current_stage() -> str:
+    return _stage.get()
+
+
+def current_labels() -> dict:
+    guild, command = _scope.get()
+    return {"guild": guild, "command": command}
+
+
+def log_event(event: str, level: int = logging.INFO, **fields):
+    # One logfmt line per event, tagged with the guild, command and stage it happened in
+    if not events.isEnabledFor(level):
+        return
+    guild, command = _scope.get()
+    tags = {"event": event, "guild": guild, "command": command, "stage": _stage.get(), **fields}
+    events.log(level, " ".join(
+        f"{key}={value}" if isinstance(value, (int, float)) else f"{key}={json.dumps(str(value))}"
+        for key, value in tags.items() if value != ""
+    ))
+
+
+def _percentile(ordered: list[float], fraction: float) -> float:
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}={json.dumps(value)}' for key, value in labels) + "}"
+
+
+class Metrics:
+    """Counters and stage timings keyed by guild and command.
+
+    Everything is in memory and rendered in the Prometheus text format on
+    request. A bounded window of recent timings per guild, command and stage
+    backs the percentiles shown by $stats.
+    """
+
+    def __init__(self, recent_samples: int = METRICS_RECENT_SAMPLES):
+        # (name, sorted label pairs) -> value
+        self.counters = defaultdict(float)
+        # sorted label pairs -> [per-bucket counts..., +Inf count, sum]
+        self.histograms = defaultdict(lambda: [0] * (len(BUCKETS) + 1) + [0.0])
+        self.recent = defaultdict(lambda: deque(maxlen=recent_samples))
+        # name -> current value, process-wide rather than per guild
+        self.gauges = {}
+        self._server = None
+
+    def count(self, name: str, value: float = 1, **labels):
+        self.counters[(name, tuple(sorted({**current_labels(), **labels}.items())))] += value
+
+    def gauge(self, name: str, value: float):
+        self.gauges[name] = value
+
+    def observe(self, stage: str, seconds: float, **labels):
+        labels = {**current_labels(), "stage": stage, **labels}
+        histogram = self.histograms[tuple(sorted(labels.items()))]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram[i] += 1
+                break
+        else:
+            histogram[len(BUCKETS)] += 1
+        histogram[-1] += seconds
+        self.recent[(labels["guild"], labels["command"], stage)].append(seconds)
+
+    @contextmanager
+    def span(self, stage: str):
+        # Time a block of work as one stage, nested spans report under their own stage
+        token = _stage.set(stage)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            _stage.reset(token)
+            self.observe(stage, elapsed)
+            log_event("span", logging.DEBUG, span=stage, ms=round(elapsed * 1000, 1))
+
+    def record_usage(self, usage):
+        # Token counts from a GenAI response's usage_metadata, when the response has one
+        if usage is None:
+            return
+        stage = _stage.get()
+        self.count("llm_tokens", usage.prompt_token_count or 0, stage=stage, kind="prompt")
+        self.count("llm_tokens", usage.candidates_token_count or 0, stage=stage, kind="output")
+
+    def percentiles(self, guild_id) -> list[tuple]:
+        # (command, stage, samples, p50, p95, p99) over the recent window for a guild
+        rows = []
+        for (guild, command, stage), samples in sorted(self.recent.items()):
+            if guild == str(guild_id) and samples:
+                ordered = sorted(samples)
+                rows.append((command, stage, len(ordered),
+                             _percentile(ordered, 0.5), _percentile(ordered, 0.95), _percentile(ordered, 0.99)))
+        return rows
+
+    def totals(self, guild_id) -> dict:
+        # Counter totals for a guild, summed over every other label
+        totals = defaultdict(float)
+        for (name, labels), value in self.counters.items():
+            if dict(labels).get("guild") == str(guild_id):
+                totals[name] += value
+        return totals
+
+    def render(self) -> str:
+        lines = []
+        by_name = defaultdict(list)
+        for (name, labels), value in self.counters.items():
+            by_name[name].append((labels, value))
+        for name, series in sorted(by_name.items()):
+            lines.append(f"# HELP {PREFIX}_{name}_total {DESCRIPTIONS.get(name, name)}")
+            lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+            lines.extend(f"{PREFIX}_{name}_total{_format_labels(labels)} {value:g}" for labels, value in series)
+        for name, value in sorted(self.gauges.items()):
+            lines.append(f"# HELP {PREFIX}_{name} {DESCRIPTIONS.get(name, name)}")
+            lines.append(f"# TYPE {PREFIX}_{name} gauge")
+            lines.append(f"{PREFIX}_{name} {value:g}")
+
+        if self.histograms:
+            name = f"{PREFIX}_stage_seconds"
+            lines.append(f"# HELP {name} {DESCRIPTIONS['stage_seconds']}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in self.histograms.items():
+                cumulative = 0
+                for bound, count in zip((*BUCKETS, "+Inf"), histogram):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram[-1]:.6f}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = (await reader.readline()).split()
+            while await reader.readline() not in (b"\r\n", b"\n", b""):
+                pass
+            if len(request) > 1 and request[1] == b"/metrics":
+                status, body = "200 OK", self.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def start_server(self, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        # Serve /metrics for Prometheus to scrape, once per process
+        if self._server is not None or not port:
+            return
+        self._server = await asyncio.start_server(self._handle, host, port)
+        logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+    def rest_trace(self, *response_listeners):
+        # aiohttp trace hooks that count and time every request discord.py makes to the REST API.
+        # Each listener is called with (method, path, status, headers) for every response.
+        import aiohttp
+
+        async def on_request_start(session, trace_ctx, params):
+            trace_ctx.start = time.perf_counter()
+
+        async def on_request_end(session, trace_ctx, params):
+            self.count("rest_requests", method=params.method, status=str(params.response.status))
+            self.observe("rest", time.perf_counter() - trace_ctx.start, method=params.method)
+            for listener in response_listeners:
+                listener(params.method, params.url.path, params.response.status, params.response.headers)
+
+        async def on_request_exception(session, trace_ctx, params):
+            self.count("rest_requests", method=params.method, status="error")
+
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(on_request_start)
+        trace.on_request_end.append(on_request_end)
+        trace.on_request_exception.append(on_request_exception)
+        return trace
+
+
+metrics = Metrics()
@@ -0,0 +1,109 @@
+import unittest
+
+from split_engine import distribute_cents, parse_notes, split_bill
+
+ALICE, BOB, CAROL = 1, 2, 3
+DINERS = [ALICE, BOB, CAROL]
+ALIASES = {"alice": ALICE, "bob": BOB, "carol": CAROL}
+RECEIPT = {"Burger 1": 12.0, "Burger 2": 12.0, "Fries": 6.0, "Fish and Chips": 15.0}
+
+
+class ParseNotesTest(unittest.TestCase):
+    def parse(self, notes, items=RECEIPT):
+        return parse_notes(notes, list(items), DINERS, ALIASES)
+
+    def test_single_item(self):
+        self.assertEqual(self.parse("bob had the fries"), ({"Fries": [BOB]}, set()))
+
+    def test_plural_claims_every_numbered_instance(self):
+        assignments, _ = self.parse("bob had the burgers")
+        self.assertEqual(assignments, {"Burger 1": [BOB], "Burger 2": [BOB]})
+        assignments, _ = self.parse("bob had burgers")
+        self.assertEqual(assignments, {"Burger 1": [BOB], "Burger 2": [BOB]})
+
+    def test_singular_with_several_instances_needs_the_llm(self):
+        self.assertIsNone(self.parse("bob had a burger"))
+        self.assertIsNone(self.parse("bob had one burger"))
+        self.assertIsNone(self.parse("bob had the burger"))
+
+    def test_singular_with_one_instance(self):
+        assignments, _ = self.parse("bob had a burger", {"Burger 1": 12.0, "Fries": 6.0})
+        self.assertEqual(assignments, {"Burger 1": [BOB]})
+
+    def test_unnumbered_first_instance_counts(self):
+        # add_unique numbers repeats from 2, leaving the first one bare
+        items = {"Burger": 12.0, "Burger 2": 12.0}
+        self.assertIsNone(self.parse("bob had a burger", items))
+        assignments, _ = self.parse("bob had the burgers", items)
+        self.assertEqual(assignments, {"Burger": [BOB], "Burger 2": [BOB]})
+
+    def test_named_instance(self):
+        assignments, _ = self.parse("bob had burger 2")
+        self.assertEqual(assignments, {"Burger 2": [BOB]})
+
+    def test_item_name_containing_and(self):
+        assignments, _ = self.parse("alice had fish and chips")
+        self.assertEqual(assignments, {"Fish and Chips": [ALICE]})
+
+    def test_shared_item_and_separate_clauses(self):
+        assignments, _ = self.parse("alice and bob had the fries, carol had burger 1")
+        self.assertEqual(assignments, {"Fries": [ALICE, BOB], "Burger 1": [CAROL]})
+
+    def test_exclusion(self):
+        self.assertEqual(self.parse("carol didn't eat"), ({}, {CAROL}))
+
+    def test_even_split(self):
+        self.assertEqual(self.parse("split evenly"), ({}, set()))
+
+    def test_partial_name_matches_whole_words(self):
+        items = {"French Fries": 5.0, "Cheese Burger": 11.0}
+        self.assertEqual(self.parse("bob had fries", items), ({"French Fries": [BOB]}, set()))
+        self.assertEqual(self.parse("bob had the burger", items), ({"Cheese Burger": [BOB]}, set()))
+
+    def test_partial_name_inside_a_word_needs_the_llm(self):
+        self.assertIsNone(self.parse("bob had tea", {"Steak": 30.0}))
+        self.assertIsNone(self.parse("bob had ham", {"Hamburger": 12.0}))
+        self.assertIsNone(self.parse("alice had pie", {"Pierogi": 9.0}))
+        self.assertIsNone(self.parse("alice had rice", {"Licorice Twist": 3.0}))
+
+    def test_unknown_user_or_item_needs_the_llm(self):
+        self.assertIsNone(self.parse("dave had the fries"))
+        self.assertIsNone(self.parse("bob had the salad"))
+        self.assertIsNone(self.parse("bob paid for drinks"))
+
+
+class SplitBillTest(unittest.TestCase):
+    def test_even_split_is_exact(self):
+        per_person = split_bill({"Pizza": 10.0}, "", DINERS, ALIASES, "")
+        self.assertEqual(sorted(per_person.values()), [3.33, 3.33, 3.34])
+
+    def test_claimed_items_and_shared_rest(self):
+        per_person = split_bill(RECEIPT, "bob had the burgers, alice had fish and chips", DINERS, ALIASES, "")
+        # Fries are shared by everyone
+        self.assertEqual(per_person, {ALICE: 17.0, BOB: 26.0, CAROL: 2.0})
+
+    def test_singular_phrase_falls_back(self):
+        self.assertIsNone(split_bill(RECEIPT, "bob had a burger", DINERS, ALIASES, ""))
+
+    def test_discount_line_keeps_total_exact(self):
+        per_person = split_bill({"Pizza": 30.0, "Coupon": -1.0}, "", DINERS, ALIASES, "")
+        self.assertAlmostEqual(sum(per_person.values()), 29.0)
+        self.assertEqual(sorted(per_person.values()), [9.66, 9.67, 9.67])
+
+    def test_negative_amount_is_distributed_exactly(self):
+        shares = distribute_cents(-100, {ALICE: 1, BOB: 1, CAROL: 1})
+        self.assertEqual(sum(shares.values()), -100)
+        self.assertEqual(sorted(shares.values()), [-34, -33, -33])
+
+    def test_tip_keeps_total_exact(self):
+        per_person = split_bill(RECEIPT, "carol didn't eat", DINERS, ALIASES, "20%")
+        self.assertEqual(set(per_person), {ALICE, BOB})
+        self.assertAlmostEqual(sum(per_person.values()), 54.0)
+
+    def test_absolute_tip(self):
+        per_person = split_bill({"Pizza": 20.0}, "", [ALICE, BOB], ALIASES, "5")
+        self.assertEqual(per_person, {ALICE: 12.5, BOB: 12.5})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import asyncio
+import contextvars
+import time
+
+from telemetry import metrics
+
+
+class WorkerPool:
+    """Fixed set of worker tasks taking jobs from a bounded local queue.
+
+    Heavy work like receipt parsing is queued here instead of being run by
+    the handler that received it, so at most `workers` jobs are in flight and
+    a burst beyond `max_queue` is turned away instead of piling up.
+    """
+
+    def __init__(self, name: str, workers: int, max_queue: int):
+        self.name = name
+        self.workers = workers
+        self._queue = asyncio.Queue(max_queue)
+        self._tasks = []
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def submit(self, fn, *args) -> asyncio.Future:
+        # Queue fn(*args), raises asyncio.QueueFull when the backlog is full
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        future = asyncio.get_running_loop().create_future()
+        # Jobs run in the submitter's context so their metrics keep its guild and command
+        self._queue.put_nowait((fn, args, future, contextvars.copy_context(), time.perf_counter()))
+        metrics.gauge(f"{self.name}_queue_depth", self.depth())
+        return future
+
+    async def _work(self):
+        while True:
+            fn, args, future, context, queued_at = await self._queue.get()
+            metrics.gauge(f"{self.name}_queue_depth", self.depth())
+            try:
+                if future.cancelled():
+                    continue
+                context.run(metrics.observe, "queue_wait", time.perf_counter() - queued_at)
+                try:
+                    result = await asyncio.create_task(fn(*args), context=context)
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+            finally:
+                self._queue.task_done()